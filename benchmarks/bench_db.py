@@ -0,0 +1,114 @@
+"""Benchmark: concurrent upserts/reads, legacy per-call connections vs. the Database repository.
+
+Usage:
+    python benchmarks/bench_db.py [--users 2000] [--concurrency 200]
+
+Each simulated user saves contact info, reads its screenshot status and records a screenshot,
+i.e. the writes and reads of `handle_contact_info` and `handle_screenshot_request`.
+  * legacy: a fresh `sqlite3.connect` per query on the event loop, rollback journal, and the old
+    `update_users_timestamp` trigger (the code before the repository existed);
+  * repository: `db.Repository` with WAL, long-lived connections and coalesced writes.
+Both run against a fresh database file in a temporary directory.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database, Repository, create_schema  # noqa: E402
+
+LEGACY_SCHEMA = ('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        contact_info TEXT,
+        state TEXT,
+        screenshot_count INTEGER DEFAULT 0,
+        last_screenshot_time TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''', '''
+    CREATE TRIGGER IF NOT EXISTS update_users_timestamp
+    AFTER UPDATE ON users FOR EACH ROW
+    BEGIN
+        UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE user_id = OLD.user_id;
+    END;
+''')
+
+
+def legacy_query(path, sql, params, fetch=False):
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.execute(sql, params)
+        result = cursor.fetchone() if fetch else None
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+
+async def legacy_user(path, user_id):
+    legacy_query(path, """
+        INSERT INTO users (user_id, contact_info, state, screenshot_count) VALUES (?, ?, ?, 0)
+        ON CONFLICT(user_id) DO UPDATE SET contact_info = excluded.contact_info, state = excluded.state;
+    """, (user_id, 'x' * 120, 'Lagos'))
+    await asyncio.sleep(0)
+    legacy_query(path, "SELECT screenshot_count, last_screenshot_time FROM users WHERE user_id = ?",
+                 (user_id,), fetch=True)
+    await asyncio.sleep(0)
+    legacy_query(path, "UPDATE users SET screenshot_count = screenshot_count + 1, last_screenshot_time = ? "
+                       "WHERE user_id = ?", (datetime.now().isoformat(), user_id))
+
+
+async def repo_user(repo, user_id):
+    await repo.save_contact(user_id, 'x' * 120, 'Lagos')
+    await repo.get_screenshot_status(user_id)
+    await repo.record_screenshot(user_id, datetime.now().isoformat())
+
+
+async def run_users(make_coro, users, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user_id):
+        async with semaphore:
+            await make_coro(user_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in range(1, users + 1)))
+    return time.perf_counter() - start
+
+
+async def main_async(users, concurrency):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        for sql in LEGACY_SCHEMA:
+            legacy_query(legacy_path, sql, ())
+        elapsed = await run_users(lambda uid: legacy_user(legacy_path, uid), users, concurrency)
+        print(f"    legacy: {users * 3 / elapsed:8,.0f} ops/sec ({elapsed:.2f} s, blocks the event loop)")
+
+        database = Database(os.path.join(tmp, 'repo.db'), schema=create_schema)
+        database.start()
+        repo = Repository(database)
+        try:
+            elapsed = await run_users(lambda uid: repo_user(repo, uid), users, concurrency)
+        finally:
+            await asyncio.to_thread(database.close)
+        print(f"repository: {users * 3 / elapsed:8,.0f} ops/sec ({elapsed:.2f} s, "
+              f"{database.writes} writes in {database.batches} transactions)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.users, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
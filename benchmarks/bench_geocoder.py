@@ -0,0 +1,80 @@
+"""Benchmark: offline StateLocator lookups vs. Nominatim reverse geocoding.
+
+Usage:
+    python benchmarks/bench_geocoder.py [--points 100000] [--nominatim 5]
+
+`--nominatim N` also times N live calls to the public Nominatim server (the pre-existing
+`get_state_from_location` path). They are spaced one second apart to respect its usage policy;
+pass 0 to skip the online part entirely.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geocoder import StateLocator  # noqa: E402
+from http_client import HttpClient  # noqa: E402
+
+NIGERIA_BBOX = (2.69, 4.27, 14.68, 13.89)  # min_lon, min_lat, max_lon, max_lat
+
+
+def random_points(n, seed=42):
+    rng = random.Random(seed)
+    x0, y0, x1, y1 = NIGERIA_BBOX
+    return [(rng.uniform(y0, y1), rng.uniform(x0, x1)) for _ in range(n)]
+
+
+def bench_offline(points):
+    start = time.perf_counter()
+    locator = StateLocator.from_file()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ambiguous = 0
+    for lat, lon in points:
+        ambiguous += locator.locate(lat, lon)[1]
+    elapsed = time.perf_counter() - start
+    print(f"offline: index built in {build_time * 1000:.1f} ms")
+    print(f"offline: {len(points)} lookups in {elapsed:.3f} s -> {len(points) / elapsed:,.0f} lookups/sec "
+          f"({elapsed / len(points) * 1e6:.2f} us/lookup, {ambiguous / len(points):.1%} ambiguous)")
+
+
+async def bench_nominatim(points):
+    client = HttpClient(timeout=10)
+    latencies = []
+    try:
+        for lat, lon in points:
+            start = time.perf_counter()
+            response = await client.get(
+                'https://nominatim.openstreetmap.org/reverse',
+                params={'format': 'json', 'lat': lat, 'lon': lon},
+                headers={'User-Agent': 'NigeriaConnectBot/1.0 (benchmark)'},
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(1)
+    finally:
+        await client.close()
+    mean = statistics.mean(latencies)
+    print(f"nominatim: {len(latencies)} lookups, mean {mean * 1000:.0f} ms -> {1 / mean:.1f} lookups/sec "
+          f"per connection (policy cap: 1 lookup/sec)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=100_000)
+    parser.add_argument('--nominatim', type=int, default=0)
+    args = parser.parse_args()
+
+    bench_offline(random_points(args.points))
+    if args.nominatim:
+        asyncio.run(bench_nominatim(random_points(args.nominatim, seed=7)))
+
+
+if __name__ == '__main__':
+    main()
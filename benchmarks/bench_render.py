@@ -0,0 +1,110 @@
+"""Benchmark: screenshot rendering, inline legacy path vs. the RenderPipeline process pool.
+
+Usage:
+    python benchmarks/bench_render.py [--images 8] [--renders 64] [--workers 4] [--format JPEG]
+
+Builds a corpus of large synthetic phone photos (12 MP JPEGs with camera-like noise), then reports
+renders/sec and p50/p99 latency for:
+  * legacy: full decode, draw, LANCZOS resize, PNG encode, run one at a time (the old inline code);
+  * pipeline: RenderPipeline with `--workers` processes and all renders submitted concurrently.
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+
+from render import RenderPipeline  # noqa: E402
+
+
+def make_corpus(count, size=(4032, 3024), seed=1):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        base = Image.linear_gradient('L').resize(size).convert('RGB')
+        noise = Image.effect_noise(size, rng.uniform(20, 60)).convert('RGB')
+        img = Image.blend(base, noise, 0.5)
+        exif = Image.Exif()
+        exif[0x0112] = 6 if i % 2 else 1  # half of them stored in portrait orientation
+        out = io.BytesIO()
+        img.save(out, format='JPEG', quality=92, exif=exif)
+        corpus.append(out.getvalue())
+    return corpus
+
+
+def legacy_render(data, watermark_text):
+    img = Image.open(io.BytesIO(data))
+    draw = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.truetype("arial.ttf", size=40)
+    except IOError:
+        font = ImageFont.load_default()
+    draw.text((10, 10), watermark_text, fill=(255, 0, 0, 128), font=font)
+    img = img.resize((int(img.width * 0.6), int(img.height * 0.6)), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
+
+
+def report(name, latencies, elapsed, sizes):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:>8}: {len(latencies) / elapsed:6.2f} renders/sec, "
+          f"p50 {statistics.median(latencies) * 1000:7.0f} ms, p99 {p99 * 1000:7.0f} ms, "
+          f"avg output {statistics.mean(sizes) / 1024:6.0f} KiB")
+
+
+def bench_legacy(corpus, renders):
+    latencies, sizes = [], []
+    start = time.perf_counter()
+    for i in range(renders):
+        t = time.perf_counter()
+        sizes.append(len(legacy_render(corpus[i % len(corpus)], "For Bench Only - Do Not Share")))
+        latencies.append(time.perf_counter() - t)
+    report('legacy', latencies, time.perf_counter() - start, sizes)
+
+
+async def bench_pipeline(corpus, renders, workers, fmt, quality):
+    pipeline = RenderPipeline(max_workers=workers, max_queue=renders, fmt=fmt, quality=quality)
+    pipeline.start()
+    latencies, sizes = [], []
+
+    async def one(i):
+        t = time.perf_counter()
+        sizes.append(len(await pipeline.render(corpus[i % len(corpus)], "For Bench Only - Do Not Share")))
+        latencies.append(time.perf_counter() - t)
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(renders)))
+        report('pipeline', latencies, time.perf_counter() - start, sizes)
+    finally:
+        pipeline.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--renders', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--format', default='JPEG', choices=['JPEG', 'WEBP'])
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.images)
+    print(f"corpus: {len(corpus)} images, avg {statistics.mean(map(len, corpus)) / 1024 / 1024:.1f} MiB")
+    if not args.skip_legacy:
+        bench_legacy(corpus, max(1, args.renders // 4))
+    asyncio.run(bench_pipeline(corpus, args.renders, args.workers, args.format, args.quality))
+
+
+if __name__ == '__main__':
+    main()
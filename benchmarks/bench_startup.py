@@ -0,0 +1,164 @@
+"""Benchmark: cold-start time of the bot, with an import-time breakdown.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--top 12]
+                                       [--save-baseline FILE | --compare FILE [--tolerance 0.25]]
+
+Two measurements, each the median of `--runs` fresh processes:
+  * import: `python -X importtime -c "import main_bot"`, with the time split by top-level package
+    (self time summed over all its modules), so a new eager import of a heavy library shows up;
+  * time to serving / ready: main_bot.py is started in webhook mode against
+    benchmarks/fake_services.py, and /healthz and /readyz are polled from the moment the process is
+    spawned. The final /readyz body breaks start-up down into phases and warm-up steps.
+As a regression check, --save-baseline stores the results and --compare exits with status 1 if the
+import, serving or ready time grows by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+from load_test import ROOT, configure_environment, free_port, start_fakes
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_breakdown(env):
+    """Returns (total ms, {top-level package: self ms}) for one `import main_bot`."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main_bot'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    total, packages = None, defaultdict(float)
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, _, module = match.groups()
+        packages[module.split('.')[0]] += int(self_us) / 1000
+        if module == 'main_bot':
+            total = int(cumulative_us) / 1000
+    return total, packages
+
+
+def time_to_ready(env, port, timeout=60):
+    """Starts the bot and returns (seconds until /healthz answered, until /readyz was 200, readyz body)."""
+    spawned = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main_bot.py'], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    serving = None
+    try:
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=1) as client:
+            while time.perf_counter() - spawned < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"main_bot.py exited with status {process.returncode}")
+                try:
+                    if serving is None:
+                        client.get('/healthz').raise_for_status()
+                        serving = time.perf_counter() - spawned
+                    response = client.get('/readyz')
+                    if response.status_code == 200:
+                        return serving, time.perf_counter() - spawned, response.json()
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError(f"main_bot.py was not ready within {timeout} s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(args):
+    fake_args = argparse.Namespace(latency=args.latency, drive_latency=None, error_rate=0.0, images_per_folder=10,
+                                   render_workers=2, real_flood_limits=False, lost_webhooks=0.0)
+    fakes_port = free_port()
+    fakes_url = f'http://127.0.0.1:{fakes_port}'
+    fakes = start_fakes(fakes_port, fake_args)
+    imports, packages, serving, ready, reports = [], defaultdict(list), [], [], []
+    try:
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as workdir:
+                port = free_port()
+                configure_environment(fakes_url, port, workdir, fake_args)
+                env = dict(os.environ, METRICS_ENABLED='false')
+                total, by_package = import_breakdown(env)
+                imports.append(total)
+                for package, ms in by_package.items():
+                    packages[package].append(ms)
+                up, done, body = time_to_ready(env, port)
+                serving.append(up)
+                ready.append(done)
+                reports.append(body)
+    finally:
+        fakes.terminate()
+        fakes.wait()
+
+    median = statistics.median
+    report = reports[sorted(range(args.runs), key=ready.__getitem__)[args.runs // 2]]  # the median run's
+    packages_ms = {package: median(ms) for package, ms in packages.items()}
+    return {
+        'import_ms': median(imports),
+        'packages_ms': dict(sorted(packages_ms.items(), key=lambda item: -item[1])),
+        'serving_s': median(serving),
+        'ready_s': median(ready),
+        'phases_ms': report['phases_ms'],
+        'steps_ms': {name: step['ms'] for name, step in report['steps'].items()},
+        'config': {'runs': args.runs, 'latency': args.latency},
+    }
+
+
+def print_report(results, top):
+    runs = results['config']['runs']
+    print(f"import main_bot: {results['import_ms']:.0f} ms (median of {runs})")
+    for package, ms in list(results['packages_ms'].items())[:top]:
+        print(f"  {package:>24} {ms:7.1f} ms")
+    print(f"serving (/healthz) after {results['serving_s']:.2f} s, ready (/readyz) after {results['ready_s']:.2f} s")
+    print("  in-process phases: " + ', '.join(f"{name} {ms:.0f} ms" for name, ms in results['phases_ms'].items()))
+    print("  warm-up steps:     " + ', '.join(f"{name} {ms:.0f} ms" for name, ms in results['steps_ms'].items()))
+
+
+def compare(results, baseline, tolerance, slack_ms=50.0):
+    """Returns a list of regressions of `results` against `baseline`."""
+    regressions = []
+    for name, key, scale in (('import', 'import_ms', 1), ('serving', 'serving_s', 1000), ('ready', 'ready_s', 1000)):
+        current, base = results[key] * scale, baseline[key] * scale
+        if current > base * (1 + tolerance) + slack_ms:
+            regressions.append(f"{name} {current:.0f} ms > baseline {base:.0f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=12, help='packages to list in the import breakdown')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of every fake service (seconds)')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args)
+    print_report(results, args.top)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
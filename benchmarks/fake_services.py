@@ -0,0 +1,388 @@
+"""Local fakes of the Telegram Bot API, Paystack, Nominatim and Google Drive for testing and load runs.
+
+Usage:
+    python benchmarks/fake_services.py [--port 9000] [--latency 0.05] [--error-rate 0.0]
+                                       [--drive-latency 0.1] [--images-per-folder 10]
+
+Serves everything on one port; point the bot at it with
+    TELEGRAM_API_URL=http://127.0.0.1:9000/bot
+    PAYSTACK_BASE_URL=http://127.0.0.1:9000/paystack
+    NOMINATIM_URL=http://127.0.0.1:9000/nominatim
+    DRIVE_API_URL=http://127.0.0.1:9000/drive/v3/ GOOGLE_SERVICE_ACCOUNT_FILE=
+Every fake takes a latency (seconds, or a (min, max) range) and an error rate for injecting 503s,
+and counts the calls it receives. `POST /_control/paystack/pay/<reference>` with
+`{"webhook_url": ...}` marks a transaction paid and delivers the signed `charge.success` event;
+without a webhook_url the payment is only visible through verify and the transaction list, as
+when a webhook is lost.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter
+
+import httpx
+import tornado.web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geocoder import StateLocator  # noqa: E402
+
+
+class Fault:
+    """Latency and error injection shared by the fakes."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+    async def apply(self):
+        delay = self.rng.uniform(*self.latency) if isinstance(self.latency, tuple) else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            raise tornado.web.HTTPError(503)
+
+
+def _params(request):
+    """Returns request parameters from a JSON, form or multipart body (PTB uses the latter two)."""
+    if request.headers.get('Content-Type', '').startswith('application/json'):
+        return json.loads(request.body or b'{}')
+    return {key: values[-1].decode() for key, values in request.body_arguments.items()}
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+
+class FakeTelegram:
+    """Answers the Bot API methods the bot uses with plausible objects."""
+
+    def __init__(self, fault=None):
+        self.fault = fault or Fault()
+        self.calls = Counter()
+        self.sent = []  # (method, params) for every message-producing call
+        self.record = True
+        self._ids = itertools.count(1)
+
+    def _message(self, chat_id, **extra):
+        message_id = next(self._ids)
+        return {'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'}, **extra}
+
+    def _photo(self):
+        n = next(self._ids)
+        return [{'file_id': f'fake-photo-{n}', 'file_unique_id': f'u{n}', 'width': 320, 'height': 320}]
+
+    def respond(self, method, params):
+        self.calls[method] += 1
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot',
+                    'can_join_groups': False, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method in ('setWebhook', 'deleteWebhook', 'answerCallbackQuery', 'setMyCommands'):
+            return True
+        if method == 'getUpdates':
+            return []
+        chat_id = params.get('chat_id', 0)
+        if self.record:
+            self.sent.append((method, params))
+        if method == 'sendMediaGroup':
+            media = json.loads(params['media']) if isinstance(params['media'], str) else params['media']
+            return [self._message(chat_id, photo=self._photo()) for _ in media]
+        if method in ('sendPhoto', 'editMessageMedia'):
+            return self._message(chat_id, photo=self._photo())
+        if method == 'sendDocument':
+            n = next(self._ids)
+            return self._message(chat_id, document={'file_id': f'fake-doc-{n}', 'file_unique_id': f'd{n}'})
+        return self._message(chat_id, text=params.get('text', ''))
+
+    def handlers(self):
+        fake = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                await fake.fault.apply()
+                result = fake.respond(method, _params(self.request))
+                self.write({'ok': True, 'result': result})
+
+            get = post
+
+        return [(r'/bot([^/]+)/(\w+)', Handler)]
+
+
+class FakePaystack:
+    """Paystack transaction API plus delivery of signed `charge.success` webhooks."""
+
+    def __init__(self, secret_key, fault=None):
+        self.secret_key = secret_key
+        self.fault = fault or Fault()
+        self.calls = Counter()
+        self.transactions = {}  # reference -> transaction dict
+        self._client = None
+
+    def pay(self, reference):
+        """Marks a transaction as paid, as if the customer completed checkout."""
+        transaction = self.transactions[reference]
+        transaction['status'] = 'success'
+        transaction['paid_at'] = _now()
+        return transaction
+
+    async def deliver_webhook(self, reference, url):
+        """Posts a signed `charge.success` event for a paid transaction to the bot."""
+        body = json.dumps({'event': 'charge.success', 'data': self.transactions[reference]}).encode()
+        signature = hmac.new(self.secret_key.encode(), body, hashlib.sha512).hexdigest()
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30)
+        response = await self._client.post(url, content=body, headers={
+            'x-paystack-signature': signature, 'Content-Type': 'application/json'})
+        return response.status_code
+
+    def handlers(self):
+        fake = self
+
+        class Initialize(tornado.web.RequestHandler):
+            async def post(self):
+                await fake.fault.apply()
+                fake.calls['initialize'] += 1
+                payload = json.loads(self.request.body)
+                reference = payload['reference']
+                fake.transactions[reference] = {
+                    'id': len(fake.transactions) + 1, 'reference': reference, 'status': 'abandoned',
+                    'amount': payload['amount'], 'metadata': payload.get('metadata') or {},
+                    'created_at': _now(),
+                }
+                self.write({'status': True, 'message': 'Authorization URL created', 'data': {
+                    'authorization_url': f'https://checkout.paystack.test/{reference}',
+                    'access_code': reference, 'reference': reference}})
+
+        class Verify(tornado.web.RequestHandler):
+            async def get(self, reference):
+                await fake.fault.apply()
+                fake.calls['verify'] += 1
+                transaction = fake.transactions.get(reference)
+                if transaction is None:
+                    self.set_status(404)
+                    self.write({'status': False, 'message': 'Transaction reference not found'})
+                    return
+                self.write({'status': True, 'message': 'Verification successful', 'data': transaction})
+
+        class List(tornado.web.RequestHandler):
+            async def get(self):
+                await fake.fault.apply()
+                fake.calls['list'] += 1
+                status = self.get_query_argument('status', None)
+                since = self.get_query_argument('from', '')[:19]
+                per_page = int(self.get_query_argument('perPage', 50))
+                page = int(self.get_query_argument('page', 1))
+                matches = [t for t in reversed(fake.transactions.values())  # newest first, like Paystack
+                           if (status is None or t['status'] == status) and t['created_at'][:19] >= since]
+                self.write({'status': True, 'message': 'Transactions retrieved',
+                            'data': matches[(page - 1) * per_page:page * per_page],
+                            'meta': {'total': len(matches), 'perPage': per_page, 'page': page,
+                                     'pageCount': max(1, -(-len(matches) // per_page))}})
+
+        class Pay(tornado.web.RequestHandler):
+            async def post(self, reference):
+                if reference not in fake.transactions:
+                    raise tornado.web.HTTPError(404)
+                fake.pay(reference)
+                webhook_url = json.loads(self.request.body or b'{}').get('webhook_url')
+                status = await fake.deliver_webhook(reference, webhook_url) if webhook_url else None
+                self.write({'reference': reference, 'webhook_status': status})
+
+        return [
+            (r'/paystack/transaction/initialize', Initialize),
+            (r'/paystack/transaction', List),
+            (r'/paystack/transaction/verify/([^/]+)', Verify),
+            (r'/_control/paystack/pay/([^/]+)', Pay),
+        ]
+
+
+class FakeNominatim:
+    """Reverse geocoding answered from the bundled state boundaries."""
+
+    def __init__(self, fault=None):
+        self.fault = fault or Fault()
+        self.calls = Counter()
+        self.locator = StateLocator.from_file()
+
+    def handlers(self):
+        fake = self
+
+        class Reverse(tornado.web.RequestHandler):
+            async def get(self):
+                await fake.fault.apply()
+                fake.calls['reverse'] += 1
+                state, _ = fake.locator.locate(float(self.get_argument('lat')), float(self.get_argument('lon')))
+                address = {'state': f'{state} State', 'country': 'Nigeria'} if state else {'country': 'Nigeria'}
+                self.write({'address': address})
+
+        return [(r'/nominatim/reverse', Reverse)]
+
+
+def make_photo(size=(1600, 1200)):
+    """Returns a JPEG with camera-like noise, so decoding and resizing cost something."""
+    from PIL import Image
+
+    base = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.effect_noise(size, 40).convert('RGB')
+    out = io.BytesIO()
+    Image.blend(base, noise, 0.5).save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+class FakeDrive:
+    """The slice of the Drive v3 REST API the bot uses: files.list/get/get_media and changes."""
+
+    def __init__(self, images_per_folder=10, image_size=(1600, 1200), fault=None, base_url=''):
+        self.images_per_folder = images_per_folder
+        self.fault = fault or Fault()
+        self.base_url = base_url
+        self.calls = Counter()
+        self.photo = make_photo(image_size)
+        self.thumbnail = make_photo((256, 192))
+        self.md5 = hashlib.md5(self.photo).hexdigest()
+
+    def _file(self, folder_id, i):
+        file_id = f'{folder_id}__{i}'
+        return {'id': file_id, 'name': f'Profile {i + 1}', 'md5Checksum': self.md5,
+                'modifiedTime': '2024-01-01T00:00:00.000Z',
+                'thumbnailLink': f'{self.base_url}/drive/thumbnails/{file_id}=s220'}
+
+    def handlers(self):
+        fake = self
+
+        class Files(tornado.web.RequestHandler):
+            async def get(self):
+                await fake.fault.apply()
+                fake.calls['files.list'] += 1
+                match = re.search(r"'([^']+)' in parents", self.get_argument('q', ''))
+                if not match:
+                    raise tornado.web.HTTPError(400)
+                page_size = int(self.get_argument('pageSize', 100))
+                offset = int(self.get_argument('pageToken', 0))
+                end = min(offset + page_size, fake.images_per_folder)
+                result = {'files': [fake._file(match.group(1), i) for i in range(offset, end)]}
+                if end < fake.images_per_folder:
+                    result['nextPageToken'] = str(end)
+                self.write(result)
+
+        class File(tornado.web.RequestHandler):
+            async def get(self, file_id):
+                await fake.fault.apply()
+                if self.get_argument('alt', None) != 'media':
+                    fake.calls['files.get'] += 1
+                    folder_id, _, i = file_id.rpartition('__')
+                    self.write(fake._file(folder_id, int(i or 0)))
+                    return
+                fake.calls['files.get_media'] += 1
+                data = fake.photo
+                match = re.match(r'bytes=(\d+)-(\d*)', self.request.headers.get('Range', ''))
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+                    self.set_status(206)
+                    self.set_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+                    data = data[start:end + 1]
+                self.set_header('Content-Type', 'image/jpeg')
+                self.write(data)
+
+        class Thumbnail(tornado.web.RequestHandler):
+            async def get(self, file_id, size):
+                await fake.fault.apply()
+                fake.calls['thumbnails'] += 1
+                self.set_header('Content-Type', 'image/jpeg')
+                self.write(fake.thumbnail)
+
+        class StartPageToken(tornado.web.RequestHandler):
+            async def get(self):
+                fake.calls['changes.getStartPageToken'] += 1
+                self.write({'startPageToken': '1'})
+
+        class Changes(tornado.web.RequestHandler):
+            async def get(self):
+                await fake.fault.apply()
+                fake.calls['changes.list'] += 1
+                self.write({'changes': [], 'newStartPageToken': self.get_argument('pageToken', '1')})
+
+        return [
+            (r'/drive/v3/files', Files),
+            (r'/drive/v3/files/([^/]+)', File),
+            (r'/drive/v3/changes/startPageToken', StartPageToken),
+            (r'/drive/v3/changes', Changes),
+            (r'/drive/thumbnails/([^/=]+)=s(\d+)', Thumbnail),
+        ]
+
+
+class FakeServices:
+    """All fakes on one Tornado app; `urls` holds the environment for pointing the bot at them."""
+
+    def __init__(self, port=9000, paystack_secret='sk_test_fake', images_per_folder=10, image_size=(1600, 1200),
+                 telegram_fault=None, paystack_fault=None, nominatim_fault=None, drive_fault=None):
+        self.port = port
+        base = f'http://127.0.0.1:{port}'
+        self.telegram = FakeTelegram(telegram_fault)
+        self.paystack = FakePaystack(paystack_secret, paystack_fault)
+        self.nominatim = FakeNominatim(nominatim_fault)
+        self.drive = FakeDrive(images_per_folder, image_size, drive_fault, base_url=base)
+        self.urls = {
+            'TELEGRAM_API_URL': f'{base}/bot',
+            'PAYSTACK_BASE_URL': f'{base}/paystack',
+            'NOMINATIM_URL': f'{base}/nominatim',
+            'DRIVE_API_URL': f'{base}/drive/v3/',
+            'GOOGLE_SERVICE_ACCOUNT_FILE': '',
+        }
+
+    def listen(self):
+        routes = [*self.telegram.handlers(), *self.paystack.handlers(), *self.nominatim.handlers(),
+                  *self.drive.handlers()]
+        return tornado.web.Application(routes).listen(self.port, address='127.0.0.1')
+
+    def calls(self):
+        return {name: dict(fake.calls) for name, fake in
+                (('telegram', self.telegram), ('paystack', self.paystack), ('nominatim', self.nominatim),
+                 ('drive', self.drive))}
+
+
+def _fault(args, name):
+    latency = getattr(args, f'{name}_latency')
+    return Fault(args.latency if latency is None else latency, args.error_rate)
+
+
+async def serve(args):
+    services = FakeServices(
+        args.port, args.paystack_secret, args.images_per_folder, tuple(args.image_size),
+        telegram_fault=_fault(args, 'telegram'), paystack_fault=_fault(args, 'paystack'),
+        nominatim_fault=_fault(args, 'nominatim'), drive_fault=_fault(args, 'drive'),
+    )
+    services.telegram.record = False  # long runs would otherwise keep every message
+    services.listen()
+    print(' '.join(f'{name}={value}' for name, value in services.urls.items()), flush=True)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help='default latency for every fake (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    for name in ('telegram', 'paystack', 'nominatim', 'drive'):
+        parser.add_argument(f'--{name}-latency', type=float, default=None)
+    parser.add_argument('--paystack-secret', default='sk_test_fake')
+    parser.add_argument('--images-per-folder', type=int, default=10)
+    parser.add_argument('--image-size', type=int, nargs=2, default=[1600, 1200])
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
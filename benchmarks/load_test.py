@@ -0,0 +1,403 @@
+"""Load test: drives main_bot's real handlers through the whole conversation with synthetic users.
+
+Usage:
+    python benchmarks/load_test.py [--users 500] [--concurrency 100] [--latency 0.05]
+                                   [--error-rate 0.0] [--real-flood-limits] [--lost-webhooks 0.0]
+                                   [--images-per-folder 10 [--browse]]
+                                   [--save-baseline FILE | --compare FILE [--tolerance 0.25]]
+
+Starts benchmarks/fake_services.py in a subprocess (Telegram Bot API, Paystack, Nominatim and
+Drive, with the given latency/error injection), points main_bot at it through the environment and
+runs its Application in webhook mode with the real update processor, send scheduler, persistence,
+database, image cache and render pool. Every user goes
+    /start -> "Yes" -> location -> image -> Paystack webhook -> contact -> screenshot
+and a stage is timed from handing the update to the Application until its handler (and the
+messages it sends) finished; the payment stage runs from asking the fake Paystack to deliver the
+signed webhook until the bot has confirmed it. With --lost-webhooks, that fraction of payments is
+made without a webhook and timed separately as "reconcile", until the bot's payment reconciler
+(run every second) has found it in Paystack's transaction list. Reports throughput, p50/p95/p99
+per stage and event-loop lag. With --browse (and more than one page of images per folder) every
+user also presses "Next" before choosing, timed as "next_page".
+
+Telegram's flood limits (which cap the bot at ~30 messages/s) are lifted unless
+--real-flood-limits is given, so the numbers measure the bot rather than the limits. As a
+regression check, --save-baseline stores the results and --compare exits with status 1 if
+throughput drops, or a stage's p95 rises, by more than --tolerance.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from cryptography.fernet import Fernet
+from telegram import Update
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from geocoder import StateLocator  # noqa: E402
+
+STAGES = ('start', 'connect', 'location', 'select_image', 'payment', 'contact', 'screenshot')
+USER_ID_BASE = 10_000_000
+PAYSTACK_SECRET = 'sk_test_load'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def sample_points(count, seed=1):
+    """Random points inside Nigeria; ones near a border also exercise the Nominatim fallback."""
+    locator, rng, points = StateLocator.from_file(), random.Random(seed), []
+    while len(points) < count:
+        lat, lon = rng.uniform(4.3, 13.9), rng.uniform(2.7, 14.7)
+        if locator.locate(lat, lon)[0]:
+            points.append((lat, lon))
+    return points
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class Updates:
+    """Builds Bot API update payloads for synthetic users."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Load{user_id}'}
+
+    def _message(self, user_id, **fields):
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), **fields}
+
+    def _update(self, **fields):
+        return Update.de_json({'update_id': next(self._update_ids), **fields}, self.bot)
+
+    def text(self, user_id, text):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text[0] == '/' else []
+        return self._update(message=self._message(user_id, text=text, entities=entities))
+
+    def location(self, user_id, latitude, longitude):
+        return self._update(message=self._message(user_id, location={'latitude': latitude, 'longitude': longitude}))
+
+    def callback(self, user_id, data):
+        message = self._message(user_id, text='...')
+        message['from'] = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot'}
+        return self._update(callback_query={'id': str(next(self._update_ids)), 'from': self._user(user_id),
+                                            'chat_instance': str(user_id), 'data': data, 'message': message})
+
+
+class LoadTest:
+    def __init__(self, main_bot, application, fakes_url, bot_url, concurrency, lost_webhooks=0.0, browse=False):
+        self.bot = main_bot
+        self.application = application
+        self.fakes_url = fakes_url
+        self.bot_url = bot_url
+        self.concurrency = concurrency
+        self.lost_webhooks = lost_webhooks
+        self.random = random.Random(1)
+        self.updates = Updates(application.bot)
+        self.browse = browse
+        self.stages = (*STAGES[:3], *(('next_page',) if browse else ()), *STAGES[3:5],
+                       *(('reconcile',) if lost_webhooks else ()), *STAGES[5:])
+        self.latencies = {stage: [] for stage in self.stages}
+        self.errors = {stage: 0 for stage in self.stages}
+        self.loop_lag = []
+        self.payments = {}  # reference -> future resolved once the bot confirmed it
+        self.completed = 0
+        self.updates_sent = 0
+        self.client = None
+
+    async def on_payment(self, data):
+        try:
+            await self.bot.confirm_payment(self.application, data)
+        finally:
+            future = self.payments.get(data.get('reference'))
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def send(self, update):
+        """Processes one update the way the Application's update fetcher does."""
+        self.updates_sent += 1
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+
+    async def stage(self, name, coro, check=None):
+        start = time.perf_counter()
+        try:
+            await coro
+            ok = check() if check else True
+        except Exception:
+            ok = False
+        if ok:
+            self.latencies[name].append(time.perf_counter() - start)
+        else:
+            self.errors[name] += 1
+        return ok
+
+    async def pay(self, reference):
+        future = self.payments[reference] = asyncio.get_running_loop().create_future()
+        try:
+            await self.client.post(f'{self.fakes_url}/_control/paystack/pay/{reference}',
+                                   json={'webhook_url': f'{self.bot_url}/paystack/webhook'})
+            await asyncio.wait_for(future, 30)
+        finally:
+            self.payments.pop(reference, None)
+
+    async def pay_without_webhook(self, reference, user_data, timeout=30):
+        await self.client.post(f'{self.fakes_url}/_control/paystack/pay/{reference}', json={})
+        deadline = time.monotonic() + timeout
+        while 'payment_confirmed' not in user_data and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def choose_image(self, user_id, user_data, page):
+        images, _, _ = await self.bot.drive_index.page(user_data['state'], page, self.bot.IMAGES_PER_PAGE)
+        await self.send(self.updates.callback(user_id, f"image_{images[0]['id']}"))
+
+    async def user_flow(self, user_id, point):
+        user_data = self.application.user_data[user_id]
+        if self.random.random() < self.lost_webhooks:
+            payment = ('reconcile', lambda: self.pay_without_webhook(user_data['payment_reference'], user_data))
+        else:
+            payment = ('payment', lambda: self.pay(user_data['payment_reference']))
+        steps = (
+            ('start', lambda: self.send(self.updates.text(user_id, '/start')), None),
+            ('connect', lambda: self.send(self.updates.callback(user_id, 'connect_yes')), None),
+            ('location', lambda: self.send(self.updates.location(user_id, *point)), lambda: 'state' in user_data),
+            *((('next_page', lambda: self.send(self.updates.callback(user_id, 'page_1')), None),) if self.browse else ()),
+            # The page whose buttons the user presses, as sent in the callback data above.
+            ('select_image', lambda: self.choose_image(user_id, user_data, 1 if self.browse else 0),
+             lambda: 'payment_reference' in user_data),
+            (*payment, lambda: 'payment_confirmed' in user_data),
+            ('contact', lambda: self.send(self.updates.text(user_id, f'Load User {user_id}, +2348000000000')), None),
+        )
+        for name, make_coro, check in steps:
+            if not await self.stage(name, make_coro(), check):
+                return
+        image_id = user_data['selected_image_id']
+
+        async def screenshot_taken():
+            count, _ = await self.bot.repo.get_screenshot_status(user_id)
+            return count == 1
+
+        start = time.perf_counter()
+        await self.send(self.updates.callback(user_id, f'screenshot_{image_id}'))
+        if await screenshot_taken():
+            self.latencies['screenshot'].append(time.perf_counter() - start)
+            self.completed += 1
+        else:
+            self.errors['screenshot'] += 1
+
+    async def monitor_loop(self, interval=0.01):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - start - interval)
+
+    async def run(self, users, points):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(i):
+            async with semaphore:
+                await self.user_flow(USER_ID_BASE + i, points[i % len(points)])
+
+        monitor = asyncio.create_task(self.monitor_loop())
+        async with httpx.AsyncClient(timeout=30) as self.client:
+            start = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(users)))
+            elapsed = time.perf_counter() - start
+        monitor.cancel()
+        return elapsed
+
+    def results(self, users, elapsed):
+        stages = {}
+        for name in self.stages:
+            values = sorted(self.latencies[name])
+            stages[name] = {
+                'count': len(values), 'errors': self.errors[name],
+                **({f'p{q}_ms': percentile(values, q / 100) * 1000 for q in (50, 95, 99)} if values else {}),
+            }
+        lag = sorted(self.loop_lag) or [0.0]
+        return {
+            'users': users,
+            'completed': self.completed,
+            'elapsed_s': elapsed,
+            'flows_per_s': self.completed / elapsed,
+            'updates_per_s': self.updates_sent / elapsed,
+            'stages': stages,
+            'loop_lag_ms': {'p50': statistics.median(lag) * 1000, 'p99': percentile(lag, 0.99) * 1000,
+                            'max': lag[-1] * 1000},
+            'reconciler': self.bot.payment_reconciler.stats(),
+        }
+
+
+def report(results):
+    print(f"\n{results['completed']}/{results['users']} flows completed in {results['elapsed_s']:.1f} s: "
+          f"{results['flows_per_s']:.1f} flows/s, {results['updates_per_s']:.1f} updates/s")
+    print(f"{'stage':>13} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, stage in results['stages'].items():
+        if stage['count']:
+            print(f"{name:>13} {stage['count']:6} {stage['errors']:6} {stage['p50_ms']:8.1f} "
+                  f"{stage['p95_ms']:8.1f} {stage['p99_ms']:8.1f}")
+        else:
+            print(f"{name:>13} {0:6} {stage['errors']:6}")
+    lag = results['loop_lag_ms']
+    print(f"event-loop lag: p50 {lag['p50']:.1f} ms, p99 {lag['p99']:.1f} ms, max {lag['max']:.1f} ms")
+    reconciler = results.get('reconciler')
+    if reconciler and reconciler['runs']:
+        print(f"payment reconciler: {reconciler['reconciled']} reconciled in {reconciler['runs']} runs, "
+              f"{reconciler['list_calls']} list calls")
+
+
+def compare(results, baseline, tolerance, slack_ms=5.0):
+    """Returns a list of regressions of `results` against `baseline`."""
+    regressions = []
+    if results['flows_per_s'] < baseline['flows_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput {results['flows_per_s']:.1f} flows/s < baseline {baseline['flows_per_s']:.1f}")
+    for name, base in baseline['stages'].items():
+        current = results['stages'].get(name, {})
+        if 'p95_ms' not in base or 'p95_ms' not in current:
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance) + slack_ms:
+            regressions.append(f"{name} p95 {current['p95_ms']:.1f} ms > baseline {base['p95_ms']:.1f} ms")
+        if current['errors'] > base['errors']:
+            regressions.append(f"{name} errors {current['errors']} > baseline {base['errors']}")
+    return regressions
+
+
+def start_fakes(port, args):
+    command = [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_services.py'), '--port', str(port),
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+               '--paystack-secret', PAYSTACK_SECRET, '--images-per-folder', str(args.images_per_folder)]
+    if args.drive_latency is not None:
+        command += ['--drive-latency', str(args.drive_latency)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()  # printed once the server is listening
+    return process
+
+
+def configure_environment(fakes_url, bot_port, workdir, args):
+    """Points main_bot at the fakes; must run before main_bot is imported."""
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:load-test',
+        'TELEGRAM_API_URL': f'{fakes_url}/bot',
+        'PAYSTACK_SECRET_KEY': PAYSTACK_SECRET,
+        'PAYSTACK_BASE_URL': f'{fakes_url}/paystack',
+        'NOMINATIM_URL': f'{fakes_url}/nominatim',
+        'NOMINATIM_MIN_INTERVAL': '0',  # the fake shares its host with the other fakes
+        'DRIVE_API_URL': f'{fakes_url}/drive/v3/',
+        'GOOGLE_SERVICE_ACCOUNT_FILE': '',
+        'ADMIN_USER_ID': '1',
+        'ENCRYPTION_KEY': Fernet.generate_key().decode(),
+        'BOT_MODE': 'webhook',
+        'BOT_WEBHOOK_URL': f'http://127.0.0.1:{bot_port}',
+        'PORT': str(bot_port),
+        'DB_PATH': os.path.join(workdir, 'load_test.db'),
+        'IMAGE_CACHE_DIR': os.path.join(workdir, 'image_cache'),
+        'MEDIA_WARMUP_CHAT_ID': '0',
+        'RENDER_WORKERS': str(args.render_workers),
+    })
+    if not args.real_flood_limits:
+        os.environ.update({'TELEGRAM_GLOBAL_RATE': '1000000', 'TELEGRAM_CHAT_RATE': '1000000'})
+    if args.lost_webhooks:
+        os.environ.update({'PAYMENT_RECONCILE_INTERVAL': '1', 'PAYMENT_RECONCILE_GRACE': '0'})
+
+
+async def run_async(main_bot, application, args, fakes_url, bot_port):
+    from webhook_server import WebhookServer
+
+    bot_url = f'http://127.0.0.1:{bot_port}'
+    test = LoadTest(main_bot, application, fakes_url, bot_url, args.concurrency, args.lost_webhooks, args.browse)
+    server = WebhookServer(
+        application, on_payment=test.on_payment, webhook_url=bot_url, telegram_path='/telegram',
+        secret_token=main_bot.WEBHOOK_SECRET, paystack_secret_key=PAYSTACK_SECRET, listen='127.0.0.1',
+        port=bot_port,
+    )
+    await application.initialize()
+    await main_bot.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        await main_bot.warmup.wait()
+        points = sample_points(min(args.users, 1000))
+        elapsed = await test.run(args.users, points)
+        return test.results(args.users, elapsed)
+    finally:
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        await main_bot.post_shutdown(application)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100, help='users in the middle of a flow at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of every fake service (seconds)')
+    parser.add_argument('--drive-latency', type=float, default=None)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--images-per-folder', type=int, default=10)
+    parser.add_argument('--browse', action='store_true', help='press "Next" before choosing an image')
+    parser.add_argument('--render-workers', type=int, default=2)
+    parser.add_argument('--real-flood-limits', action='store_true')
+    parser.add_argument('--lost-webhooks', type=float, default=0.0,
+                        help='fraction of payments made without a webhook, left to the reconciler')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    fakes_port, bot_port = free_port(), free_port()
+    fakes_url = f'http://127.0.0.1:{fakes_port}'
+    fakes = start_fakes(fakes_port, args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            configure_environment(fakes_url, bot_port, workdir, args)
+            import logging
+            import main_bot
+            logging.getLogger().setLevel(logging.WARNING)
+
+            main_bot.render_pipeline.start()
+            main_bot.database.start()
+            application = main_bot.build_application()
+            results = asyncio.run(run_async(main_bot, application, args, fakes_url, bot_port))
+    finally:
+        fakes.terminate()
+        fakes.wait()
+
+    results['config'] = {name: getattr(args, name) for name in
+                         ('users', 'concurrency', 'latency', 'drive_latency', 'error_rate', 'images_per_folder',
+                          'render_workers', 'real_flood_limits', 'lost_webhooks', 'browse')}
+    report(results)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+
+from media_cache import version_of
+
+logger = logging.getLogger(__name__)
+
+SHEET_KIND = 'contact_sheet'
+
+# Drive thumbnail links end in a size parameter (`=s220`) that can be changed to get another size.
+THUMBNAIL_SIZE = re.compile(r'=s\d+$')
+# What Google's thumbnail server answers for a link whose signature has expired.
+EXPIRED_LINK_STATUS_CODES = frozenset({403, 404})
+
+
+class ThumbnailCache:
+    """Small in-memory LRU of Drive thumbnails (each image's `thumbnailLink`) for contact sheets.
+
+    Thumbnails are a few KB each and come from Drive's thumbnail server at `size` pixels through
+    the shared HttpClient, so building a sheet never downloads an original; those stay in the
+    ImageCache for screenshots. The links expire after a few hours: on a 403/404 the file's folder
+    is re-listed with `relist(file_id)` (which returns fresh metadata, or None if the file is gone)
+    and the fetch is retried once. Entries are keyed by file id and version, and the least recently
+    used are dropped past `max_bytes`. Concurrent requests for one entry share a fetch.
+    """
+
+    def __init__(self, http_client, relist, max_bytes=16 * 1024 * 1024, size=256):
+        self.http_client = http_client
+        self.relist = relist
+        self.max_bytes = max_bytes
+        self.size = size
+        self._entries = OrderedDict()  # (file id, version) -> JPEG bytes, least recently used first
+        self._total = 0
+        self._inflight = {}  # (file id, version) -> asyncio.Task of a fetch
+        self.hits = 0
+        self.misses = 0
+        self.relists = 0
+        self.evictions = 0
+
+    async def get(self, file):
+        """Returns the thumbnail bytes for a Drive file metadata dict."""
+        key = (file['id'], version_of(file))
+        data = self._entries.get(key)
+        if data is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return data
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, file))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, file):
+        response = await self._download(file)
+        if response.status_code in EXPIRED_LINK_STATUS_CODES:
+            self.relists += 1
+            fresh = await self.relist(file['id'])
+            if fresh is None:
+                raise KeyError(f"{file['id']} is no longer in its folder")
+            response = await self._download(fresh)
+        response.raise_for_status()
+        data = response.content
+        self._entries[key] = data
+        self._total += len(data)
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._total -= len(evicted)
+            self.evictions += 1
+        return data
+
+    async def _download(self, file):
+        link = file.get('thumbnailLink')
+        if not link:
+            raise KeyError(f"{file['id']} has no thumbnail")
+        return await self.http_client.get(THUMBNAIL_SIZE.sub(f'=s{self.size}', link))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'relists': self.relists,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._total,
+        }
+
+
+class ContactSheets:
+    """One numbered grid image per set of images, sent as a single photo instead of a media group.
+
+    Sheets are keyed by a hash of their images' ids and versions, so every user shown the same
+    images gets the same sheet. The first send uploads it, and later sends reuse its Telegram
+    file_id, which is kept in the TelegramFileCache and survives restarts. Sheets are composited
+    from Drive's thumbnails (see ThumbnailCache) in the render pool. Rendered
+    bytes that have not been uploaded yet wait in a small LRU. `schedule()` renders a sheet in the
+    background; it is hooked to the folder index so a new sheet is ready as soon as a listing changes.
+    """
+
+    def __init__(self, thumbnails, render_pipeline, media_cache, max_rendered=64, concurrency=2):
+        self.thumbnails = thumbnails
+        self.render_pipeline = render_pipeline
+        self.media_cache = media_cache
+        self.max_rendered = max_rendered
+        self._rendered = OrderedDict()  # digest -> JPEG bytes not yet uploaded, least recently used first
+        self._inflight = {}  # digest -> asyncio.Task of a render
+        self._background = asyncio.Semaphore(concurrency)
+        self._scheduled = set()  # background render tasks
+        self.renders = 0
+        self.reuses = 0
+        self.incomplete = 0
+
+    @staticmethod
+    def digest(files):
+        """Returns the content hash identifying the sheet for these images, in this order."""
+        h = hashlib.sha256()
+        for file in files:
+            h.update(f"{file['id']}:{version_of(file)}\n".encode())
+        return h.hexdigest()[:32]
+
+    async def photo(self, files):
+        """Returns `(photo, digest)`: a cached Telegram file_id, or freshly rendered bytes.
+
+        `digest` is None if some images could not be fetched; such a sheet is sent but never cached.
+        """
+        digest = self.digest(files)
+        file_id = self.media_cache.get(digest, '', SHEET_KIND)  # the digest covers the versions
+        if file_id is not None:
+            self.reuses += 1
+            return file_id, digest
+        data = self._rendered.get(digest)
+        if data is not None:
+            self._rendered.move_to_end(digest)
+            return data, digest
+        data, complete = await self._render(digest, files)
+        return data, digest if complete else None
+
+    async def uploaded(self, digest, file_id):
+        """Records the file_id Telegram gave an uploaded sheet, so it is never uploaded again."""
+        if digest is None:
+            return
+        self._rendered.pop(digest, None)
+        await self.media_cache.put(digest, '', SHEET_KIND, file_id)
+
+    def _render(self, digest, files):
+        """Renders a sheet, sharing the work with any render of the same digest already running."""
+        task = self._inflight.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._do_render(digest, files))
+            self._inflight[digest] = task
+            task.add_done_callback(lambda _: self._inflight.pop(digest, None))
+        return asyncio.shield(task)
+
+    async def _do_render(self, digest, files):
+        sources = await asyncio.gather(*(self.thumbnails.get(file) for file in files), return_exceptions=True)
+        data, blank = await self.render_pipeline.contact_sheet(
+            [None if isinstance(source, Exception) else source for source in sources]
+        )
+        complete = not blank
+        self.renders += 1
+        if complete:
+            self._rendered[digest] = data
+            while len(self._rendered) > self.max_rendered:
+                self._rendered.popitem(last=False)
+        else:
+            self.incomplete += 1
+            logger.warning(f"Contact sheet {digest} is missing images; it won't be cached.")
+        return data, complete
+
+    def schedule(self, files):
+        """Renders the sheet for `files` in the background unless it is already available."""
+        if not files:
+            return
+        digest = self.digest(files)
+        if digest in self._rendered or digest in self._inflight or \
+                self.media_cache.has(digest, '', SHEET_KIND):
+            return
+
+        async def run():
+            async with self._background:
+                try:
+                    await self._render(digest, files)
+                except Exception as e:
+                    logger.error(f"Pre-rendering contact sheet {digest} failed: {e}")
+        task = asyncio.ensure_future(run())
+        self._scheduled.add(task)
+        task.add_done_callback(self._scheduled.discard)
+
+    async def wait_scheduled(self):
+        """Waits for every background render scheduled so far."""
+        await asyncio.gather(*self._scheduled)
+
+    def pending_uploads(self):
+        """Returns `[(digest, bytes)]` for rendered sheets Telegram doesn't have yet."""
+        return list(self._rendered.items())
+
+    def stats(self):
+        return {
+            'renders': self.renders,
+            'reuses': self.reuses,
+            'incomplete': self.incomplete,
+            'rendered_waiting': len(self._rendered),
+            'rendering': len(self._inflight),
+        }
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+logger = logging.getLogger(__name__)
+
+
+def key_id(key):
+    """Short, stable identifier of a Fernet key, stored next to each row it encrypted."""
+    return hashlib.sha256(key if isinstance(key, bytes) else key.encode()).hexdigest()[:8]
+
+
+class ContactCipher:
+    """Encrypts contact info with a `MultiFernet` over versioned keys.
+
+    `keys` are ordered newest first: the first encrypts, and any of them decrypts, so a new key
+    can be added in front while rows encrypted under older ones stay readable until
+    `KeyRotation` has re-encrypted them. Each ciphertext is stored with the `key_id` of the key
+    that produced it, so rotation only touches rows that need it.
+    """
+
+    def __init__(self, keys):
+        keys = [key if isinstance(key, bytes) else key.encode() for key in keys if key]
+        if not keys:
+            raise ValueError("At least one encryption key is required.")
+        self._fernet = MultiFernet([Fernet(key) for key in keys])
+        self.key_id = key_id(keys[0])
+        self.key_ids = [key_id(key) for key in keys]
+
+    @classmethod
+    def from_env(cls, keys=None, key=None):
+        """Builds a cipher from ENCRYPTION_KEYS (comma-separated, newest first) or ENCRYPTION_KEY."""
+        values = [k.strip() for k in (keys or '').split(',') if k.strip()] or ([key] if key else [])
+        return cls(values)
+
+    def encrypt(self, text):
+        return self._fernet.encrypt(text.encode()).decode()
+
+    def decrypt(self, token):
+        return self._fernet.decrypt(token.encode()).decode()
+
+    def rotate(self, token):
+        """Re-encrypts a token under the newest key."""
+        return self._fernet.rotate(token.encode()).decode()
+
+    def decrypt_many(self, tokens):
+        """Decrypts a batch; a token no configured key can read comes back as None."""
+        results = []
+        for token in tokens:
+            try:
+                results.append(self.decrypt(token) if token else None)
+            except InvalidToken:
+                results.append(None)
+        return results
+
+
+class KeyRotation:
+    """Re-encrypts every stored contact under the cipher's newest key, in bounded batches.
+
+    Each batch of `batch_size` rows is read on a reader thread and re-encrypted in a worker
+    thread. It is then written back in one transaction, and only where the row hasn't changed
+    in the meantime. The bot keeps serving throughout, and at most one batch is held in memory.
+    Rows no key can decrypt are skipped and counted. Safe to stop and re-run: finished rows
+    already carry the new key id.
+    """
+
+    def __init__(self, repo, cipher, batch_size=500):
+        self.repo = repo
+        self.cipher = cipher
+        self.batch_size = batch_size
+        self.running = False
+        self.rotated = 0
+        self.unreadable = 0
+        self.conflicts = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def _rotate_batch(self, rows):
+        updates, unreadable = [], 0
+        for user_id, token in rows:
+            try:
+                updates.append((self.cipher.rotate(token), user_id, token))
+            except InvalidToken:
+                unreadable += 1
+        return updates, unreadable
+
+    async def run(self):
+        """Rotates all rows not yet under the newest key; returns the number rotated by this run."""
+        if self.running:
+            raise RuntimeError("Key rotation is already running.")
+        self.running = True
+        start = time.perf_counter()
+        rotated = 0
+        try:
+            async for rows in self.repo.iter_contacts_to_rotate(self.cipher.key_id, self.batch_size):
+                updates, unreadable = await asyncio.to_thread(self._rotate_batch, rows)
+                written = await self.repo.update_contacts(updates, self.cipher.key_id)
+                rotated += written
+                self.rotated += written
+                self.conflicts += len(updates) - written
+                self.unreadable += unreadable
+                self.batches += 1
+        finally:
+            self.running = False
+            self.elapsed += time.perf_counter() - start
+        logger.info(f"Key rotation finished: {rotated} rows re-encrypted under key {self.cipher.key_id}.")
+        return rotated
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'rotated': self.rotated,
+            'unreadable': self.unreadable,
+            'conflicts': self.conflicts,
+            'batches': self.batches,
+            'rows_per_s': self.rotated / self.elapsed if self.elapsed else None,
+        }
+
+
+async def iter_decrypted_contacts(repo, cipher, batch_size=500):
+    """Yields batches of (user_id, state, contact or None), decrypting each batch in a worker thread."""
+    async for rows in repo.iter_contacts(batch_size):
+        contacts = await asyncio.to_thread(cipher.decrypt_many, [row[2] for row in rows])
+        yield [(user_id, state, contact) for (user_id, state, _), contact in zip(rows, contacts)]
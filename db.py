@@ -0,0 +1,455 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # durable across app crashes; WAL fsyncs on checkpoint
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",  # 16 MiB page cache per connection
+    "PRAGMA mmap_size=67108864",
+)
+
+
+class Database:
+    """SQLite access off the event loop: one writer thread plus a small pool of reader threads.
+
+    Each thread keeps a long-lived connection (so sqlite3's per-connection statement cache keeps
+    queries prepared) and the database runs in WAL mode, letting readers proceed while a write
+    commits. Writes are queued to the writer thread, which drains whatever is waiting and commits
+    it as one transaction; each write runs in its own savepoint so one failure doesn't abort the
+    rest, and its future resolves only once the batch is durable.
+    """
+
+    def __init__(self, path, schema=None, readers=2, max_batch=256):
+        self.path = path
+        self.schema = schema
+        self.readers = readers
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._writer = None
+        self._reader_pool = None
+        self._local = threading.local()
+        self.batches = 0
+        self.writes = 0
+
+    def _connect(self, query_only=False):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if query_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _init_reader(self):
+        self._local.conn = self._connect(query_only=True)
+
+    def start(self):
+        """Opens the connections and starts the writer thread."""
+        if self._writer is not None:
+            return
+        conn = self._connect()  # also switches the file to WAL before any reader opens it
+        if self.schema is not None:
+            conn.execute("BEGIN IMMEDIATE")
+            self.schema(conn)
+            conn.execute("COMMIT")
+        self._writer = threading.Thread(target=self._write_loop, args=(conn,), name='db-writer', daemon=True)
+        self._writer.start()
+        self._reader_pool = ThreadPoolExecutor(
+            max_workers=self.readers, thread_name_prefix='db-reader', initializer=self._init_reader
+        )
+        logger.info(f"Database {self.path} opened (WAL, {self.readers} readers).")
+
+    def close(self):
+        """Flushes queued writes and closes every connection."""
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._reader_pool.shutdown(wait=True)
+        self._reader_pool = None
+
+    def _write_loop(self, conn):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # finish this batch, then stop
+                    break
+                batch.append(item)
+            self._run_batch(conn, batch)
+        conn.close()
+
+    def _run_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, _, _ in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((fn(conn, *args), None))
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(None, e)] * len(batch)
+        self.batches += 1
+        self.writes += len(batch)
+        for (_, _, future, loop), (result, error) in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+    async def write(self, fn, *args):
+        """Runs `fn(conn, *args)` on the writer thread inside a batched transaction."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, args, future, loop))
+        return await future
+
+    async def execute(self, sql, params=()):
+        """Queues a single write statement; returns its rowcount."""
+        return await self.write(_execute, sql, params)
+
+    def _read(self, fn, args):
+        return fn(self._local.conn, *args)
+
+    async def read(self, fn, *args):
+        """Runs `fn(conn, *args)` on a reader thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._reader_pool, self._read, fn, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def create_schema(conn):
+    """Creates or migrates the bot's tables; pass as `Database(path, schema=create_schema)`."""
+    has_counters = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'"
+    ).fetchone() is not None
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        contact_info TEXT,
+        state TEXT,
+        screenshot_count INTEGER DEFAULT 0,
+        last_screenshot_time TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        contact_key_id TEXT
+    )''')
+    # Id of the encryption key contact_info is under; NULL for rows written before keys were versioned.
+    if 'contact_key_id' not in {row[1] for row in conn.execute("PRAGMA table_info(users)")}:
+        conn.execute("ALTER TABLE users ADD COLUMN contact_key_id TEXT")
+    # updated_at is now set by each UPDATE; the trigger doubled every write.
+    conn.execute("DROP TRIGGER IF EXISTS update_users_timestamp")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS telegram_media (
+        drive_file_id TEXT NOT NULL,
+        version TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        telegram_file_id TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (drive_file_id, version, kind)
+    )''')
+    # Contact sheets used to be stored under a placeholder id with their digest as the version.
+    conn.execute("""
+        UPDATE OR IGNORE telegram_media SET drive_file_id = version, version = ''
+        WHERE kind = 'contact_sheet' AND drive_file_id = 'contact_sheet'
+    """)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS kv_store (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (namespace, key)
+    )''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS payments (
+        reference TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        image_id TEXT,
+        amount INTEGER,
+        status TEXT NOT NULL DEFAULT 'pending',
+        paid_at TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        notified_at TEXT
+    )''')
+    # When the user was asked for their contact info; NULL for a paid row means the message failed.
+    if 'notified_at' not in {row[1] for row in conn.execute("PRAGMA table_info(payments)")}:
+        conn.execute("ALTER TABLE payments ADD COLUMN notified_at TEXT")
+        conn.execute("UPDATE payments SET notified_at = updated_at WHERE status = 'success'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_state ON users (state)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)")
+    # Analytics counters, kept current by the Repository in the same transaction as each write.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        metric TEXT NOT NULL,
+        dimension TEXT NOT NULL DEFAULT '',
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (metric, dimension)
+    )''')
+    if not has_counters:
+        _backfill_counters(conn)
+
+
+def _backfill_counters(conn):
+    """Seeds the counters from existing rows, once, when the counters table is first created."""
+    conn.execute("INSERT INTO stats_counters SELECT 'users', '', COUNT(*) FROM users")
+    conn.execute("INSERT INTO stats_counters SELECT 'users_by_state', COALESCE(state, ''), COUNT(*) "
+                 "FROM users GROUP BY COALESCE(state, '')")
+    conn.execute("INSERT INTO stats_counters SELECT 'users_by_day', date(created_at), COUNT(*) "
+                 "FROM users WHERE created_at IS NOT NULL GROUP BY date(created_at)")
+    conn.execute("INSERT INTO stats_counters SELECT 'screenshots', '', COALESCE(SUM(screenshot_count), 0) FROM users")
+
+
+def _today():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _bump(conn, metric, dimension='', amount=1):
+    conn.execute("""
+        INSERT INTO stats_counters (metric, dimension, value) VALUES (?, ?, ?)
+        ON CONFLICT(metric, dimension) DO UPDATE SET value = value + excluded.value
+    """, (metric, dimension, amount))
+
+
+def _save_contact(conn, user_id, contact_info, state, cipher):
+    key_id = None
+    if cipher is not None:
+        contact_info, key_id = cipher.encrypt(contact_info), cipher.key_id
+    row = conn.execute("SELECT state FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    conn.execute("""
+        INSERT INTO users (user_id, contact_info, state, screenshot_count, contact_key_id)
+        VALUES (?, ?, ?, 0, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+        contact_info = excluded.contact_info,
+        state = excluded.state,
+        contact_key_id = excluded.contact_key_id,
+        updated_at = CURRENT_TIMESTAMP;
+    """, (user_id, contact_info, state, key_id))
+    if row is None:
+        _bump(conn, 'users')
+        _bump(conn, 'users_by_state', state)
+        _bump(conn, 'users_by_day', _today())
+    elif row[0] != state:
+        _bump(conn, 'users_by_state', row[0] or '', -1)
+        _bump(conn, 'users_by_state', state)
+
+
+def _bump_daily(conn, metric):
+    _bump(conn, metric)
+    _bump(conn, f'{metric}_by_day', _today())
+
+
+def _create_payment(conn, reference, user_id, image_id, amount):
+    created = conn.execute("""
+        INSERT INTO payments (reference, user_id, image_id, amount) VALUES (?, ?, ?, ?)
+        ON CONFLICT(reference) DO NOTHING
+    """, (reference, user_id, image_id, amount)).rowcount
+    if created:
+        _bump_daily(conn, 'payments_initialized')
+
+
+def _mark_payment_paid(conn, reference, user_id, image_id, amount, paid_at):
+    # Inserts the row if the payment predates the ledger; never touches one already paid.
+    changed = conn.execute("""
+        INSERT INTO payments (reference, user_id, image_id, amount, status, paid_at)
+        VALUES (?, ?, ?, ?, 'success', ?)
+        ON CONFLICT(reference) DO UPDATE SET
+        status = 'success', paid_at = excluded.paid_at, updated_at = CURRENT_TIMESTAMP
+        WHERE payments.status != 'success'
+    """, (reference, user_id, image_id, amount, paid_at)).rowcount
+    if changed:
+        _bump_daily(conn, 'payments_confirmed')
+    return bool(changed)
+
+
+def _update_contacts(conn, updates, key_id):
+    # Compare-and-set: a contact saved since the batch was read keeps its new value.
+    return conn.executemany(
+        "UPDATE users SET contact_info = ?, contact_key_id = ? WHERE user_id = ? AND contact_info = ?",
+        [(token, key_id, user_id, old_token) for token, user_id, old_token in updates],
+    ).rowcount
+
+
+def _record_screenshot(conn, user_id, taken_at):
+    updated = conn.execute("""
+        UPDATE users SET screenshot_count = screenshot_count + 1, last_screenshot_time = ?,
+        updated_at = CURRENT_TIMESTAMP WHERE user_id = ?
+    """, (taken_at, user_id)).rowcount
+    if updated:
+        _bump(conn, 'screenshots')
+        _bump(conn, 'screenshots_by_day', _today())
+
+
+class Repository:
+    """The bot's queries, in one place, on top of a `Database`.
+
+    With a `cipher` (a `crypto.ContactCipher`), `save_contact` encrypts on the writer thread as
+    part of the write's transaction; without one, contact info is stored as given.
+    """
+
+    def __init__(self, db, cipher=None):
+        self.db = db
+        self.cipher = cipher
+
+    async def count_users(self):
+        return await self.get_counter('users')
+
+    async def get_counter(self, metric, dimension=''):
+        row = await self.db.fetchone(
+            "SELECT value FROM stats_counters WHERE metric = ? AND dimension = ?", (metric, dimension)
+        )
+        return row[0] if row else 0
+
+    async def get_counters(self, metric, since=None):
+        """Returns {dimension: value} for a metric, optionally only dimensions >= `since` (e.g. a date)."""
+        if since is None:
+            rows = await self.db.fetchall("SELECT dimension, value FROM stats_counters WHERE metric = ?", (metric,))
+        else:
+            rows = await self.db.fetchall(
+                "SELECT dimension, value FROM stats_counters WHERE metric = ? AND dimension >= ?", (metric, since)
+            )
+        return dict(rows)
+
+    async def save_contact(self, user_id, contact_info, state):
+        await self.db.write(_save_contact, user_id, contact_info, state, self.cipher)
+
+    async def _pages(self, columns, batch_size, where='1', params=()):
+        """Yields batches of user rows (user_id first), paging by primary key so only one is held at a time."""
+        sql = f"SELECT {columns} FROM users WHERE user_id > ? AND ({where}) ORDER BY user_id LIMIT ?"
+        last_id = -1
+        while True:
+            rows = await self.db.fetchall(sql, (last_id, *params, batch_size))
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    async def iter_user_ids(self, batch_size=500):
+        async for rows in self._pages('user_id', batch_size):
+            yield [row[0] for row in rows]
+
+    async def iter_user_rows(self, batch_size=1000):
+        """Yields batches of (user_id, state, screenshot_count, last_screenshot_time, created_at, updated_at)."""
+        async for rows in self._pages(
+            'user_id, state, screenshot_count, last_screenshot_time, created_at, updated_at', batch_size
+        ):
+            yield rows
+
+    async def iter_contacts(self, batch_size=500):
+        """Yields batches of (user_id, state, encrypted contact_info) for users with contact info."""
+        async for rows in self._pages('user_id, state, contact_info', batch_size, 'contact_info IS NOT NULL'):
+            yield rows
+
+    async def iter_contacts_to_rotate(self, key_id, batch_size=500):
+        """Yields batches of (user_id, encrypted contact_info) not yet encrypted under `key_id`."""
+        async for rows in self._pages('user_id, contact_info', batch_size,
+                                      'contact_info IS NOT NULL AND contact_key_id IS NOT ?', (key_id,)):
+            yield rows
+
+    async def update_contacts(self, updates, key_id):
+        """Writes re-encrypted `(token, user_id, old_token)` rows; returns how many were still unchanged."""
+        if not updates:
+            return 0
+        return await self.db.write(_update_contacts, updates, key_id)
+
+    async def get_screenshot_status(self, user_id):
+        """Returns (screenshot_count, last_screenshot_time) for a user; (0, None) if unknown."""
+        row = await self.db.fetchone(
+            "SELECT screenshot_count, last_screenshot_time FROM users WHERE user_id = ?", (user_id,)
+        )
+        return (row[0], row[1]) if row else (0, None)
+
+    async def record_screenshot(self, user_id, taken_at):
+        await self.db.write(_record_screenshot, user_id, taken_at)
+
+    async def create_payment(self, reference, user_id, image_id, amount):
+        """Records a pending payment in the ledger (a no-op if the reference is already there)."""
+        await self.db.write(_create_payment, reference, user_id, image_id, amount)
+
+    async def mark_payment_paid(self, reference, user_id, image_id, amount=None, paid_at=None):
+        """Marks a payment successful; returns False if it already was, so callers act on it once."""
+        return await self.db.write(_mark_payment_paid, reference, user_id, image_id, amount, paid_at)
+
+    async def pending_payments(self, since, until):
+        """Returns {reference: (user_id, image_id, created_at)} for pending payments created in [since, until)."""
+        rows = await self.db.fetchall("""
+            SELECT reference, user_id, image_id, created_at FROM payments
+            WHERE status = 'pending' AND created_at >= ? AND created_at < ?
+        """, (since, until))
+        return {row[0]: row[1:] for row in rows}
+
+    async def mark_payment_notified(self, reference):
+        """Records that the user was asked for their contact info after paying."""
+        await self.db.execute(
+            "UPDATE payments SET notified_at = CURRENT_TIMESTAMP WHERE reference = ?", (reference,)
+        )
+
+    async def unnotified_payments(self, since, until):
+        """Returns {reference: (user_id, image_id)} for paid payments, created since `since` and marked
+        paid before `until`, whose user was never told."""
+        rows = await self.db.fetchall("""
+            SELECT reference, user_id, image_id FROM payments
+            WHERE status = 'success' AND notified_at IS NULL AND created_at >= ? AND updated_at < ?
+        """, (since, until))
+        return {row[0]: row[1:] for row in rows}
+
+    async def expire_payments(self, before):
+        """Marks pending payments created before `before` as abandoned; returns how many."""
+        return await self.db.execute("""
+            UPDATE payments SET status = 'abandoned', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'pending' AND created_at < ?
+        """, (before,))
+
+    async def load_media_file_ids(self):
+        return await self.db.fetchall(
+            "SELECT drive_file_id, version, kind, telegram_file_id FROM telegram_media"
+        )
+
+    async def save_media_file_id(self, drive_file_id, version, kind, telegram_file_id):
+        await self.db.execute("""
+            INSERT INTO telegram_media (drive_file_id, version, kind, telegram_file_id)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(drive_file_id, version, kind) DO UPDATE SET
+            telegram_file_id = excluded.telegram_file_id;
+        """, (drive_file_id, version, kind, telegram_file_id))
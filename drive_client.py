@@ -0,0 +1,113 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class DriveClientPool:
+    """Hands out Drive API clients without rebuilding them per request.
+
+    Credentials are loaded once and shared; the Drive discovery document is read once from the copy
+    bundled with google-api-python-client (no discovery fetch at startup). Because httplib2 is not
+    thread-safe, each thread gets its own client, built on first use and reused afterwards.
+    `refresh_if_needed()` renews the access token ahead of expiry so requests never pay for it.
+
+    The Google libraries are imported when the first client is built, not when this module loads.
+
+    `api_endpoint` points the clients at another Drive-compatible server (e.g. the local fake in
+    benchmarks/); without a `service_account_file` requests are sent unauthenticated.
+    """
+
+    def __init__(self, service_account_file, scopes, http_timeout=30, refresh_margin=300, api_endpoint=None):
+        self.service_account_file = service_account_file
+        self.scopes = scopes
+        self.http_timeout = http_timeout
+        self.refresh_margin = refresh_margin
+        self.api_endpoint = api_endpoint
+        self._credentials = None
+        self._discovery_doc = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.credentials_load_ms = None
+        self.clients_built = 0
+        self.build_ms_total = 0.0
+        self.service_calls = 0
+        self.token_refreshes = 0
+
+    def _load(self):
+        """Loads credentials and the discovery document once (thread-safe)."""
+        with self._lock:
+            if self._credentials is not None:
+                return
+            from google.auth.credentials import AnonymousCredentials
+            from google.oauth2.service_account import Credentials
+            from googleapiclient.discovery_cache import get_static_doc
+
+            start = time.perf_counter()
+            if self.service_account_file:
+                credentials = Credentials.from_service_account_file(self.service_account_file, scopes=self.scopes)
+            else:
+                credentials = AnonymousCredentials()
+            self._discovery_doc = json.loads(get_static_doc('drive', 'v3'))
+            self._credentials = credentials
+            self.credentials_load_ms = (time.perf_counter() - start) * 1000
+            logger.info(f"Loaded Drive credentials and discovery document in {self.credentials_load_ms:.1f} ms")
+
+    def service(self):
+        """Returns this thread's Drive client, building it on first use."""
+        self.service_calls += 1
+        service = getattr(self._local, 'service', None)
+        if service is not None:
+            return service
+
+        self._load()
+        import google_auth_httplib2
+        import httplib2
+        from googleapiclient.discovery import build_from_document
+
+        start = time.perf_counter()
+        http = google_auth_httplib2.AuthorizedHttp(self._credentials, http=httplib2.Http(timeout=self.http_timeout))
+        client_options = {'api_endpoint': self.api_endpoint} if self.api_endpoint else None
+        service = build_from_document(self._discovery_doc, http=http, client_options=client_options)
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.clients_built += 1
+            self.build_ms_total += elapsed
+        logger.info(f"Built Drive client for thread {threading.current_thread().name} in {elapsed:.1f} ms")
+        self._local.service = service
+        return service
+
+    def refresh_if_needed(self):
+        """Blocking: refreshes the shared access token if it expires within `refresh_margin` seconds."""
+        if self._credentials is None:
+            self._load()
+        if not self.service_account_file:
+            return False  # anonymous credentials never expire
+        import google_auth_httplib2
+        import httplib2
+
+        with self._lock:
+            expiry = self._credentials.expiry
+            if expiry is not None:
+                remaining = (expiry.replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+                if remaining > self.refresh_margin:
+                    return False
+            self._credentials.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=self.http_timeout)))
+            self.token_refreshes += 1
+        logger.info("Refreshed Drive access token.")
+        return True
+
+    def stats(self):
+        """Returns startup and per-request cost counters."""
+        expiry = getattr(self._credentials, 'expiry', None)
+        return {
+            'credentials_load_ms': self.credentials_load_ms,
+            'clients_built': self.clients_built,
+            'avg_build_ms': self.build_ms_total / self.clients_built if self.clients_built else None,
+            'service_calls': self.service_calls,
+            'token_refreshes': self.token_refreshes,
+            'token_expiry': expiry.isoformat() if expiry else None,
+        }
@@ -0,0 +1,255 @@
+import asyncio
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+FILE_FIELDS = 'id, name, thumbnailLink, md5Checksum, modifiedTime'
+# Drive thumbnail links outlive this by hours, so a listing this recent has fresh ones.
+RELIST_MIN_AGE = 60
+
+
+class DriveUnavailableError(Exception):
+    """Raised when no Drive client could be created."""
+
+
+class DriveFolderIndex:
+    """In-memory index of the images in each state's Drive folder.
+
+    Listings for every folder are loaded at startup and then kept current by polling the Drive
+    changes feed (`changes.list` with a saved page token), which patches individual entries in
+    place. A listing older than `ttl` seconds is still served but triggers a background re-list, so
+    a missed change can never pin stale data forever. `get()` is a dict lookup on the hot path.
+    Callbacks registered with `add_listener` are called with `(state, files)` whenever a state's
+    listing is loaded or changed.
+    """
+
+    def __init__(self, folder_ids, service_factory, ttl=900, max_concurrency=8):
+        self.folder_ids = dict(folder_ids)
+        self.service_factory = service_factory
+        self.ttl = ttl
+        self.max_concurrency = max_concurrency
+        self._state_by_folder = {folder_id: state for state, folder_id in self.folder_ids.items()}
+        self._listings = {}  # state -> {file_id: file metadata dict}, in listing order
+        self._fetched_at = {}  # state -> time.monotonic() of the last full listing
+        self._refreshing = {}  # state -> asyncio.Task of an in-flight listing
+        self._page_token = None
+        self._listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.changes_applied = 0
+
+    def add_listener(self, callback):
+        """Registers `callback(state, files)`, called after a state's listing is loaded or changed."""
+        self._listeners.append(callback)
+
+    def _notify(self, state):
+        files = list(self._listings[state].values())
+        for callback in self._listeners:
+            try:
+                callback(state, files)
+            except Exception as e:
+                logger.error(f"Drive index listener failed for {state}: {e}")
+
+    def _service(self):
+        service = self.service_factory()
+        if not service:
+            raise DriveUnavailableError("Drive service is unavailable")
+        return service
+
+    def _list_folder(self, folder_id):
+        """Blocking: returns every image in a folder, following `nextPageToken`."""
+        service = self._service()
+        files, page_token = [], None
+        while True:
+            results = service.files().list(
+                q=f"'{folder_id}' in parents and mimeType contains 'image/' and trashed = false",
+                fields=f"nextPageToken, files({FILE_FIELDS})",
+                orderBy='name',
+                pageSize=1000,
+                pageToken=page_token,
+            ).execute()
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return files
+
+    async def refresh(self, state):
+        """Re-lists one state's folder, sharing the call with any refresh already in flight."""
+        task = self._refreshing.get(state)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(state))
+            self._refreshing[state] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(state, None))
+        return await task
+
+    async def _refresh(self, state):
+        files = await asyncio.to_thread(self._list_folder, self.folder_ids[state])
+        self._listings[state] = {f['id']: f for f in files}
+        self._fetched_at[state] = time.monotonic()
+        self.refreshes += 1
+        self._notify(state)
+        return files
+
+    async def warm(self):
+        """Loads every folder listing and records the changes-feed start token.
+
+        A folder that fails is listed again on first use; if none could be listed (Drive is
+        unreachable), raises DriveUnavailableError so the warm-up step is retried.
+        """
+        started = time.monotonic()
+        try:
+            self._page_token = await asyncio.to_thread(self._start_page_token)
+        except Exception as e:
+            logger.error(f"Could not get Drive changes start token: {e}")
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def load(state):
+            async with semaphore:
+                try:
+                    await self.refresh(state)
+                except Exception as e:
+                    logger.error(f"Failed to index Drive folder for {state}: {e}")
+
+        await asyncio.gather(*(load(state) for state in self.folder_ids))
+        logger.info(f"Indexed {len(self._listings)}/{len(self.folder_ids)} Drive folders "
+                    f"in {time.monotonic() - started:.1f}s")
+        if self.folder_ids and not self._listings:
+            raise DriveUnavailableError("No Drive folder could be listed")
+
+    async def _listing(self, state):
+        listing = self._listings.get(state)
+        if listing is None:
+            self.misses += 1
+            await self.refresh(state)
+            return self._listings[state]
+
+        self.hits += 1
+        if time.monotonic() - self._fetched_at[state] > self.ttl:
+            self.stale_hits += 1
+            if state not in self._refreshing:
+                self.refresh_in_background(state)
+        return listing
+
+    async def get(self, state):
+        """Returns the list of image metadata dicts for a state, serving from memory when possible."""
+        return list((await self._listing(state)).values())
+
+    async def page(self, state, page, size):
+        """Returns `(files, page, total)` for one page of a state's listing, `page` counting from 0.
+
+        A page past the end (the listing shrank since the caller saw it) is clamped to the last one.
+        Only the requested slice is copied out of the listing.
+        """
+        listing = await self._listing(state)
+        total = len(listing)
+        page = max(0, min(page, (total - 1) // size))
+        start = page * size
+        return list(itertools.islice(listing.values(), start, start + size)), page, total
+
+    def all_files(self):
+        """Returns the metadata of every indexed image across all states."""
+        return [file for listing in self._listings.values() for file in listing.values()]
+
+    def find(self, file_id):
+        """Returns the indexed metadata for a file id, or None if it isn't in any listing."""
+        for listing in self._listings.values():
+            file = listing.get(file_id)
+            if file is not None:
+                return file
+        return None
+
+    async def relist(self, file_id):
+        """Re-lists the folder holding a file (for a fresh `thumbnailLink`); returns its metadata or None.
+
+        A folder listed less than `RELIST_MIN_AGE` seconds ago is not listed again, so a batch of
+        expired links in one folder costs a single listing.
+        """
+        for state, listing in self._listings.items():
+            if file_id in listing:
+                if time.monotonic() - self._fetched_at[state] >= RELIST_MIN_AGE:
+                    await self.refresh(state)
+                return self._listings[state].get(file_id)
+        return None
+
+    def refresh_in_background(self, state):
+        async def run():
+            try:
+                await self.refresh(state)
+            except Exception as e:
+                logger.error(f"Background refresh of {state} folder failed: {e}")
+        asyncio.ensure_future(run())
+
+    def _start_page_token(self):
+        return self._service().changes().getStartPageToken().execute()['startPageToken']
+
+    def _fetch_changes(self, page_token):
+        """Blocking: returns (changes, new start token) since `page_token`."""
+        service = self._service()
+        changes = []
+        while True:
+            results = service.changes().list(
+                pageToken=page_token,
+                fields=f"nextPageToken, newStartPageToken, "
+                       f"changes(fileId, removed, file({FILE_FIELDS}, mimeType, parents, trashed))",
+                includeRemoved=True,
+                pageSize=1000,
+            ).execute()
+            changes.extend(results.get('changes', []))
+            if 'newStartPageToken' in results:
+                return changes, results['newStartPageToken']
+            page_token = results['nextPageToken']
+
+    def _apply_change(self, change):
+        """Patches the listings for one change; returns the states whose listing it touched.
+
+        A new or changed file is put back at its place by name, the order `_list_folder` asks Drive
+        for, so the pages (and the contact sheets) of the rest of the folder don't shift.
+        """
+        file_id = change.get('fileId')
+        file = change.get('file') or {}
+        touched = {state for state, listing in self._listings.items() if listing.pop(file_id, None) is not None}
+        if change.get('removed') or file.get('trashed') or not file.get('mimeType', '').startswith('image/'):
+            return touched
+        for parent in file.get('parents', []):
+            state = self._state_by_folder.get(parent)
+            if state in self._listings:
+                listing = self._listings[state]
+                listing[file_id] = {k: file.get(k) for k in ('id', 'name', 'thumbnailLink',
+                                                             'md5Checksum', 'modifiedTime')}
+                # Stable, so files Drive already returned in order keep their places.
+                self._listings[state] = dict(sorted(listing.items(), key=lambda item: item[1].get('name') or ''))
+                touched.add(state)
+        return touched
+
+    async def poll_changes(self):
+        """Applies changes from the Drive changes feed; returns the number applied."""
+        if self._page_token is None:
+            self._page_token = await asyncio.to_thread(self._start_page_token)
+            return 0
+        changes, self._page_token = await asyncio.to_thread(self._fetch_changes, self._page_token)
+        touched = set()
+        for change in changes:
+            touched |= self._apply_change(change)
+        for state in touched:
+            self._notify(state)
+        self.changes_applied += len(changes)
+        return len(changes)
+
+    def stats(self):
+        """Returns hit/miss/staleness counters and listing ages for monitoring."""
+        now = time.monotonic()
+        ages = [now - fetched_at for fetched_at in self._fetched_at.values()]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'refreshes': self.refreshes,
+            'changes_applied': self.changes_applied,
+            'folders_indexed': len(self._listings),
+            'oldest_listing_age': max(ages) if ages else None,
+        }
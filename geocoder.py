@@ -0,0 +1,169 @@
+import json
+import logging
+import math
+import os
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLYGONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nigeria_states.json')
+
+NO_STATE = -1
+BORDER_CELL = -2
+
+
+def _orientation(ax, ay, bx, by, cx, cy):
+    value = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    return (value > 0) - (value < 0)
+
+
+class StateLocator:
+    """Offline point-in-polygon lookup of Nigerian states.
+
+    Boundaries are indexed by a uniform lon/lat grid built once at load time. Cells that no border
+    passes through are resolved to a single state up front, so most lookups are one array index.
+    Border cells keep a flat `array('d')` of just the edges that cross them plus the state at the
+    cell centre; a lookup there counts how many local edges the segment from the point to the
+    centre crosses, which decides membership without touching the rest of the polygon.
+
+    The bundled outlines are simplified, so a point within `border_margin` degrees of an edge (or
+    just outside every polygon) is reported as ambiguous and callers may confirm it online.
+    """
+
+    def __init__(self, states, cell_size=0.1, border_margin=0.02):
+        self.cell_size = cell_size
+        self.border_margin = border_margin
+        self.names = list(states)
+        rings = [[array('d', ring) for ring in state_rings] for state_rings in states.values()]
+        bboxes = []
+        for state_rings in rings:
+            lons = [v for ring in state_rings for v in ring[0::2]]
+            lats = [v for ring in state_rings for v in ring[1::2]]
+            bboxes.append((min(lons), min(lats), max(lons), max(lats)))
+
+        # Pad the grid by the border margin so near-miss points still find their neighbours.
+        self.min_lon = min(b[0] for b in bboxes) - border_margin
+        self.min_lat = min(b[1] for b in bboxes) - border_margin
+        self.max_lon = max(b[2] for b in bboxes) + border_margin
+        self.max_lat = max(b[3] for b in bboxes) + border_margin
+        self.cols = int(math.ceil((self.max_lon - self.min_lon) / cell_size))
+        self.rows = int(math.ceil((self.max_lat - self.min_lat) / cell_size))
+        size = self.cols * self.rows
+
+        # Assign every edge (padded by the margin) to the cells it touches.
+        edges = {}
+        for idx, state_rings in enumerate(rings):
+            for ring in state_rings:
+                n = len(ring)
+                xj, yj = ring[n - 2], ring[n - 1]
+                for i in range(0, n, 2):
+                    xi, yi = ring[i], ring[i + 1]
+                    c0, r0 = self._cell(min(xi, xj) - border_margin, min(yi, yj) - border_margin)
+                    c1, r1 = self._cell(max(xi, xj) + border_margin, max(yi, yj) + border_margin)
+                    for r in range(r0, r1 + 1):
+                        for c in range(c0, c1 + 1):
+                            edges.setdefault(r * self.cols + c, []).append((idx, xj, yj, xi, yi))
+                    xj, yj = xi, yi
+
+        # `cells[key]` is a state index, NO_STATE, or BORDER_CELL; border cells also get the state
+        # at their centre and their local edges (x1, y1, x2, y2 in `segments`, owner in `owners`).
+        self.cells = array('i', [NO_STATE]) * size
+        self.centre_state = {}
+        self.segments = {}
+        self.owners = {}
+        for key in range(size):
+            r, c = divmod(key, self.cols)
+            lon = self.min_lon + (c + 0.5) * cell_size
+            lat = self.min_lat + (r + 0.5) * cell_size
+            state = NO_STATE
+            for idx, (x0, y0, x1, y1) in enumerate(bboxes):
+                if x0 <= lon <= x1 and y0 <= lat <= y1 and self._contains(rings[idx], lon, lat):
+                    state = idx
+                    break
+            if key in edges:
+                self.cells[key] = BORDER_CELL
+                self.centre_state[key] = state
+                self.segments[key] = array('d', [v for edge in edges[key] for v in edge[1:]])
+                self.owners[key] = array('i', [edge[0] for edge in edges[key]])
+            else:
+                self.cells[key] = state
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_POLYGONS_PATH, **kwargs):
+        """Loads state outlines from a JSON file in the bundled `data/nigeria_states.json` format."""
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f)['states'], **kwargs)
+
+    def _cell(self, lon, lat):
+        c = int((lon - self.min_lon) / self.cell_size)
+        r = int((lat - self.min_lat) / self.cell_size)
+        return min(max(c, 0), self.cols - 1), min(max(r, 0), self.rows - 1)
+
+    @staticmethod
+    def _contains(rings, lon, lat):
+        # Even-odd ray casting over every ring, which also handles holes and multi-part states.
+        inside = False
+        for ring in rings:
+            n = len(ring)
+            xj, yj = ring[n - 2], ring[n - 1]
+            for i in range(0, n, 2):
+                xi, yi = ring[i], ring[i + 1]
+                if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+                    inside = not inside
+                xj, yj = xi, yi
+        return inside
+
+    def _locate_in_border_cell(self, key, lon, lat):
+        r, c = divmod(key, self.cols)
+        cx = self.min_lon + (c + 0.5) * self.cell_size
+        cy = self.min_lat + (r + 0.5) * self.cell_size
+        segments, owners = self.segments[key], self.owners[key]
+        flips = {}
+        nearest, nearest_distance = NO_STATE, math.inf
+        for i, owner in enumerate(owners):
+            x1, y1, x2, y2 = segments[4 * i], segments[4 * i + 1], segments[4 * i + 2], segments[4 * i + 3]
+            if (_orientation(x1, y1, x2, y2, lon, lat) != _orientation(x1, y1, x2, y2, cx, cy)
+                    and _orientation(lon, lat, cx, cy, x1, y1) != _orientation(lon, lat, cx, cy, x2, y2)):
+                flips[owner] = not flips.get(owner, False)
+            dx, dy = x2 - x1, y2 - y1
+            length = dx * dx + dy * dy
+            t = 0.0 if length == 0 else max(0.0, min(1.0, ((lon - x1) * dx + (lat - y1) * dy) / length))
+            px, py = x1 + t * dx - lon, y1 + t * dy - lat
+            distance = px * px + py * py
+            if distance < nearest_distance:
+                nearest, nearest_distance = owner, distance
+
+        # Membership at the centre is known; each crossed edge of a state toggles it.
+        centre = self.centre_state[key]
+        state = NO_STATE
+        if centre != NO_STATE and not flips.get(centre, False):
+            state = centre
+        else:
+            for owner, flipped in flips.items():
+                if flipped and owner != centre:
+                    state = owner
+                    break
+
+        near_border = nearest_distance < self.border_margin * self.border_margin
+        if state != NO_STATE:
+            return self.names[state], near_border
+        if near_border:
+            # Just outside the simplified outlines: best guess is the nearest state.
+            return self.names[nearest], True
+        return None, False
+
+    def locate(self, latitude, longitude):
+        """Returns `(state, ambiguous)` for a coordinate.
+
+        `state` is None if the point is not in or near Nigeria. `ambiguous` is True when the point
+        lies close to a state border or just outside the simplified outlines.
+        """
+        lon, lat = float(longitude), float(latitude)
+        if not (self.min_lon <= lon <= self.max_lon and self.min_lat <= lat <= self.max_lat):
+            return None, False
+        c, r = self._cell(lon, lat)
+        key = r * self.cols + c
+        state = self.cells[key]
+        if state == BORDER_CELL:
+            return self._locate_in_border_cell(key, lon, lat)
+        return (self.names[state], False) if state != NO_STATE else (None, False)
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Methods that are safe to resend after the request may have reached the server.
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(httpx.HTTPError):
+    """Raised when a host's circuit breaker is open and the call is short-circuited."""
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker: opens after consecutive failures, half-opens after a cooldown."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        """Returns True if a call may go through (closed, or half-open after the cooldown)."""
+        if self.opened_at is None:
+            return True
+        return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            # Re-arm the cooldown on every failure so a failed half-open probe reopens the circuit.
+            self.opened_at = time.monotonic()
+
+
+class HttpClient:
+    """Shared async HTTP client with a pooled keep-alive connection per host.
+
+    All outbound calls (Nominatim, Paystack) go through one instance so connections are reused,
+    each host gets a concurrency limit and a circuit breaker, and transient failures are retried
+    with jittered exponential backoff. `host_intervals` maps a host to the minimum number of seconds
+    between the starts of two requests to it, for APIs whose usage policy is a rate rather than a
+    number of connections. Call `start()` / `close()` from the Application lifecycle.
+    """
+
+    def __init__(self, timeout=10.0, max_connections=100, max_keepalive=20,
+                 default_host_limit=10, host_limits=None, host_intervals=None, retries=2,
+                 backoff_base=0.5, backoff_max=5.0, failure_threshold=5, reset_timeout=30.0):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.default_host_limit = default_host_limit
+        self.host_limits = dict(host_limits or {})
+        self.host_intervals = dict(host_intervals or {})
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._client = None
+        self._semaphores = {}
+        self._next_start = {}  # host -> time.monotonic() before which no request to it may start
+        self._breakers = {}
+
+    async def start(self):
+        """Opens the underlying connection pool."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                ),
+            )
+            logger.info("HTTP client started.")
+
+    async def close(self):
+        """Closes the connection pool."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("HTTP client closed.")
+
+    def _semaphore(self, host):
+        if host not in self._semaphores:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            self._semaphores[host] = asyncio.Semaphore(limit)
+        return self._semaphores[host]
+
+    async def _wait_for_slot(self, host):
+        """Sleeps until a request to `host` may start under its minimum interval, and reserves that slot."""
+        interval = self.host_intervals.get(host)
+        if not interval:
+            return
+        now = time.monotonic()
+        start = max(now, self._next_start.get(host, now))
+        self._next_start[host] = start + interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def breaker(self, host):
+        """Returns the circuit breaker for a host."""
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self._breakers[host]
+
+    def _backoff(self, attempt):
+        # "Full jitter": sleep a random amount up to the capped exponential delay.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _should_retry(self, method, error=None, response=None):
+        if response is not None:
+            return method in IDEMPOTENT_METHODS and response.status_code in RETRYABLE_STATUS_CODES
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            # The request never reached the server, so resending is safe for any method.
+            return True
+        return method in IDEMPOTENT_METHODS and isinstance(error, httpx.TransportError)
+
+    async def request(self, method, url, **kwargs):
+        """Sends a request and returns the `httpx.Response`.
+
+        Raises `CircuitOpenError` if the host is currently failing, or the last `httpx.HTTPError`
+        once retries are exhausted. Callers are expected to call `raise_for_status()` themselves.
+        """
+        if self._client is None:
+            await self.start()
+        method = method.upper()
+        host = urlsplit(url).hostname
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {host}")
+
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore(host):
+                    await self._wait_for_slot(host)
+                    response = await self._client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                breaker.record_failure()
+                if attempt >= self.retries or not self._should_retry(method, error=e):
+                    raise
+                logger.warning(f"{method} {host} failed ({e!r}), retrying (attempt {attempt + 1})")
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                if attempt >= self.retries or not self._should_retry(method, response=response):
+                    return response
+                logger.warning(f"{method} {host} returned {response.status_code}, retrying (attempt {attempt + 1})")
+            await asyncio.sleep(self._backoff(attempt))
+            attempt += 1
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {host}")
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """Size-bounded on-disk cache of original images.
+
+    Entries are keyed by file id and version (md5Checksum or modifiedTime), so an edited image is
+    fetched again while an unchanged one is downloaded once. `download(file_id, fileobj)` is a
+    blocking callable that streams the content into `fileobj`; it runs in a worker thread and
+    writes to a temp file that is renamed into place, so memory stays bounded and readers never see
+    partial files. Concurrent requests for the same entry share a single download, and the least
+    recently used entries are evicted once the cache grows past `max_bytes`. `get()` pins the entry
+    it returns so it can't be evicted while the caller reads it; pair every `get()` with `release()`.
+    """
+
+    def __init__(self, directory, max_bytes, download):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.download = download
+        self._entries = OrderedDict()  # filename -> size, least recently used first
+        self._total = 0
+        self._lock = threading.Lock()
+        self._inflight = {}  # filename -> asyncio.Future of the path
+        self._pins = {}  # filename -> number of callers between get() and release()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Rebuilds the LRU order from files left by a previous run, least recently used first."""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                os.remove(path)  # interrupted download
+                continue
+            st = os.stat(path)
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total += size
+        self._evict()
+
+    @staticmethod
+    def _filename(file_id, version):
+        return hashlib.sha256(f"{file_id}:{version}".encode()).hexdigest()
+
+    def _evict(self):
+        with self._lock:
+            # Pinned entries are skipped; they become evictable again once released.
+            for name in list(self._entries):
+                if self._total <= self.max_bytes or len(self._entries) <= 1:
+                    break
+                if name in self._pins:
+                    continue
+                size = self._entries.pop(name)
+                self._total -= size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def _fetch(self, file_id, name):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.download(file_id, f)
+            path = os.path.join(self.directory, name)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        size = os.path.getsize(path)
+        with self._lock:
+            self._entries[name] = size
+            self._total += size
+            self._pin(name)
+        self._evict()
+        return path
+
+    def _pin(self, name):
+        self._pins[name] = self._pins.get(name, 0) + 1
+
+    def release(self, path):
+        """Unpins an entry returned by `get()`, making it evictable again."""
+        name = os.path.basename(path)
+        with self._lock:
+            count = self._pins.pop(name, 0) - 1
+            if count > 0:
+                self._pins[name] = count
+        self._evict()
+
+    def _release_abandoned(self, fetch):
+        if not fetch.cancelled() and fetch.exception() is None:
+            self.release(fetch.result())
+
+    async def get(self, file_id, version=''):
+        """Returns the local path of a file's content, downloading it on a miss.
+
+        The entry stays pinned until `release(path)` is called.
+        """
+        name = self._filename(file_id, version)
+        shared = False
+        while True:
+            with self._lock:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                    self._pin(name)
+                    if not shared:
+                        self.hits += 1
+                    path = os.path.join(self.directory, name)
+                    try:
+                        os.utime(path)  # persist recency for the LRU order after a restart
+                    except FileNotFoundError:
+                        pass
+                    return path
+
+            future = self._inflight.get(name)
+            if future is None:
+                break
+            # Pinned by the downloader, so normally still cached; if not, it is fetched again.
+            await asyncio.shield(future)
+            shared = True
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[name] = future
+        fetch = asyncio.ensure_future(asyncio.to_thread(self._fetch, file_id, name))
+        try:
+            path = await asyncio.shield(fetch)
+            future.set_result(path)
+            return path
+        except asyncio.CancelledError:
+            # The download thread can't be stopped; unpin what it fetches since nobody will release it.
+            fetch.add_done_callback(self._release_abandoned)
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved so a download nobody else waited on isn't logged
+            raise
+        finally:
+            del self._inflight[name]
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'pinned': len(self._pins),
+            'bytes': self._total,
+        }
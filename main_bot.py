@@ -1,23 +1,46 @@
-import sqlite3
+import time
+
+_started_at = time.perf_counter()  # start-up is measured from here; see the Start-up section below
+
+import asyncio
+import csv
+import functools
+import hashlib
+import io
 import os
+import sqlite3
+import tempfile
 import logging
-import requests
-import io
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ForceReply
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ForceReply, Message
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     filters, ContextTypes, ConversationHandler
 )
 from telegram.constants import ParseMode
 
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from PIL import Image, ImageDraw, ImageFont
-from cryptography.fernet import Fernet
 from dotenv import load_dotenv
+import httpx
+
+from contact_sheet import ContactSheets, ThumbnailCache
+from crypto import ContactCipher, KeyRotation, iter_decrypted_contacts
+from db import Database, Repository, create_schema
+from drive_client import DriveClientPool
+from drive_index import DriveFolderIndex, DriveUnavailableError
+from geocoder import StateLocator
+from http_client import HttpClient
+from image_cache import ImageCache
+from media_cache import TelegramFileCache, version_of
+from metrics import Metrics, MetricsHandler
+from persistence import SQLiteKeyValueStore, StorePersistence
+from reconciler import PaymentReconciler
+from render import RenderPipeline
+from send_scheduler import PRIORITY_BULK, PRIORITY_HIGH, SendScheduler
+from startup import Warmup, health_routes, start_status_server
+from update_scheduler import BoundedUpdateQueue, KeyedUpdateProcessor
+from webhook_server import WebhookServer, run_with_webhooks
 
 # --- Configuration & Initialization ---
 
@@ -33,26 +56,45 @@ logger = logging.getLogger(__name__)
 # Load sensitive data and configuration from environment variables
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 PAYSTACK_SECRET_KEY = os.getenv('PAYSTACK_SECRET_KEY')
-ENCRYPTION_KEY_STR = os.getenv('ENCRYPTION_KEY')
+ENCRYPTION_KEYS = os.getenv('ENCRYPTION_KEYS')  # comma-separated, newest first
+ENCRYPTION_KEY_STR = os.getenv('ENCRYPTION_KEY')  # single key, if ENCRYPTION_KEYS isn't set
 ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID', 0))
 BOT_WEBHOOK_URL = os.getenv('BOT_WEBHOOK_URL') # e.g., https://your-app-name.herokuapp.com
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+PORT = int(os.getenv('PORT', 8443))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
 
 # Validate that essential environment variables are set
 if not all([TELEGRAM_TOKEN, PAYSTACK_SECRET_KEY, ADMIN_USER_ID, BOT_WEBHOOK_URL]):
     raise ValueError("Missing essential environment variables. Please check your .env file.")
 
-# Set up encryption: load key or generate a new one
-if ENCRYPTION_KEY_STR:
-    ENCRYPTION_KEY = ENCRYPTION_KEY_STR.encode()
-else:
-    logger.warning("ENCRYPTION_KEY not found. Generating a new one. PLEASE SET THIS IN YOUR .env FILE.")
-    ENCRYPTION_KEY = Fernet.generate_key()
-    print(f"Generated ENCRYPTION_KEY: {ENCRYPTION_KEY.decode()}")
-cipher_suite = Fernet(ENCRYPTION_KEY)
+# Set up encryption. There is deliberately no generated fallback: a fresh key would leave every
+# stored contact unreadable. To rotate, put the new key first in ENCRYPTION_KEYS and run /rotate_keys.
+if not (ENCRYPTION_KEYS or ENCRYPTION_KEY_STR):
+    raise ValueError("Missing ENCRYPTION_KEYS (or ENCRYPTION_KEY). Please check your .env file.")
+contact_cipher = ContactCipher.from_env(ENCRYPTION_KEYS, ENCRYPTION_KEY_STR)
+
+# Telegram echoes this in a header on every webhook call, so only Telegram can post updates to us.
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()
 
 # --- State Definitions for ConversationHandler ---
 SELECTING_ACTION, GETTING_LOCATION, CHOOSING_IMAGE, AWAITING_PAYMENT, GETTING_CONTACT = range(5)
 
+# --- Metrics Configuration ---
+# Handler/dependency latencies, funnel counts and component stats in Prometheus format at /metrics:
+# on PORT in webhook mode, on METRICS_PORT (next to the health checks) when polling. METRICS_TOKEN,
+# if set, is required as a bearer token.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9090))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+metrics = Metrics(
+    enabled=METRICS_ENABLED,
+    state_names={
+        SELECTING_ACTION: 'SELECTING_ACTION', GETTING_LOCATION: 'GETTING_LOCATION',
+        CHOOSING_IMAGE: 'CHOOSING_IMAGE', AWAITING_PAYMENT: 'AWAITING_PAYMENT', GETTING_CONTACT: 'GETTING_CONTACT',
+    },
+)
+
 # --- Google Drive Configuration ---
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 DRIVE_FOLDER_IDS = {
@@ -77,62 +119,229 @@ DRIVE_FOLDER_IDS = {
     'Zamfara': 'your_folder_id_Zamfara',
 }
 NIGERIAN_STATES = list(DRIVE_FOLDER_IDS.keys())
+IMAGES_PER_PAGE = int(os.getenv('IMAGES_PER_PAGE', 10))  # one contact sheet; Prev/Next pages through the rest
+DRIVE_INDEX_TTL = int(os.getenv('DRIVE_INDEX_TTL', 900))  # seconds before a listing is re-fetched
+DRIVE_CHANGES_POLL_INTERVAL = int(os.getenv('DRIVE_CHANGES_POLL_INTERVAL', 60))
+GOOGLE_SERVICE_ACCOUNT_FILE = os.getenv('GOOGLE_SERVICE_ACCOUNT_FILE', 'service_account.json')
+# Another Drive-compatible endpoint, e.g. the local fake used by benchmarks/load_test.py; leave
+# GOOGLE_SERVICE_ACCOUNT_FILE empty to call it unauthenticated.
+DRIVE_API_URL = os.getenv('DRIVE_API_URL')
+
+# --- Database Configuration ---
+# All queries go through the repository; SQLite runs in WAL mode on its own threads.
+DB_PATH = os.getenv('DB_PATH', 'user_data.db')
+database = Database(DB_PATH, schema=create_schema)
+repo = Repository(database, cipher=contact_cipher)
+key_rotation = KeyRotation(repo, contact_cipher, batch_size=int(os.getenv('KEY_ROTATION_BATCH_SIZE', 500)))
+
+# Conversation states and user_data survive restarts; see persistence.py.
+persistence = StorePersistence(
+    SQLiteKeyValueStore(database),
+    update_interval=float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', 5)),
+)
+
+# --- Update Scheduling Configuration ---
+# Different users' updates run concurrently; each user's updates still run one at a time, in order,
+# which is what the ConversationHandler relies on.
+update_processor = KeyedUpdateProcessor(
+    workers=int(os.getenv('UPDATE_WORKERS', 16)),
+    max_pending=int(os.getenv('UPDATE_MAX_PENDING', 256)),
+)
+# Past UPDATE_MAX_PENDING unfinished updates, the webhook answers 503 and polling stops fetching.
+update_queue = BoundedUpdateQueue(update_processor.max_concurrent_updates)
+
+# --- Outbound Message Configuration ---
+# Every send to a chat goes through one queue that keeps under Telegram's flood limits
+# (~30 messages/s overall, ~1/s per chat) and retries after RetryAfter instead of failing.
+send_scheduler = SendScheduler(
+    global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', 30)),
+    chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', 1)),
+)
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 500))
+
+# --- Analytics Configuration ---
+# /stats reads counters the repository keeps up to date on every write, so it costs the same at any
+# table size. /export_users reads this many rows at a time while streaming the CSV to a temp file.
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+
+# --- Telegram Media Cache Configuration ---
+# Contact sheets are uploaded once and then sent by file_id. If set, newly rendered sheets are
+# pre-uploaded to this private chat in the background so users rarely hit an uncached one.
+MEDIA_WARMUP_CHAT_ID = int(os.getenv('MEDIA_WARMUP_CHAT_ID', 0))
+MEDIA_WARMUP_BATCH = int(os.getenv('MEDIA_WARMUP_BATCH', 20))
+MEDIA_WARMUP_INTERVAL = int(os.getenv('MEDIA_WARMUP_INTERVAL', 300))
+media_cache = TelegramFileCache(repo)
+
+# --- Screenshot Rendering Configuration ---
+# Watermarking runs in worker processes; output is lossy JPEG/WebP instead of full-size PNG.
+render_pipeline = RenderPipeline(
+    max_workers=int(os.getenv('RENDER_WORKERS', 2)),
+    fmt=os.getenv('SCREENSHOT_FORMAT', 'JPEG').upper(),
+    quality=int(os.getenv('SCREENSHOT_QUALITY', 80)),
+)
+
+# --- Outbound HTTP Configuration ---
+NOMINATIM_URL = os.getenv('NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+PAYSTACK_BASE_URL = os.getenv('PAYSTACK_BASE_URL', 'https://api.paystack.co')
+
+# Nominatim's usage policy allows at most 1 request/second: requests start at least
+# NOMINATIM_MIN_INTERVAL seconds apart, one at a time. Set it to 0 only for a self-hosted instance
+# without that policy (which also lifts the one-at-a-time limit on its host).
+NOMINATIM_HOST = urlsplit(NOMINATIM_URL).hostname
+NOMINATIM_MIN_INTERVAL = float(os.getenv('NOMINATIM_MIN_INTERVAL', 1.0))
+
+# Shared client for all outbound calls; opened and closed with the Application (see main()).
+http_client = HttpClient(
+    timeout=float(os.getenv('HTTP_TIMEOUT', 10)),
+    host_limits={NOMINATIM_HOST: 1} if NOMINATIM_MIN_INTERVAL else {},
+    host_intervals={NOMINATIM_HOST: NOMINATIM_MIN_INTERVAL},
+)
+
+# --- Payment Reconciliation Configuration ---
+# Every initialized payment is recorded in the payments ledger. A background job picks up ones
+# still pending after PAYMENT_RECONCILE_GRACE seconds (a lost or late webhook) from Paystack's
+# transaction list; after PAYMENT_PENDING_WINDOW seconds they are marked abandoned. The same job
+# re-sends the "payment confirmed" message to paid users whose first one failed.
+PAYMENT_AMOUNT_KOBO = 5000  # NGN 50
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv('PAYMENT_RECONCILE_INTERVAL', 300))
+payment_reconciler = PaymentReconciler(
+    repo, http_client, PAYSTACK_BASE_URL, PAYSTACK_SECRET_KEY,
+    window=float(os.getenv('PAYMENT_PENDING_WINDOW', 24 * 3600)),
+    grace=float(os.getenv('PAYMENT_RECONCILE_GRACE', 120)),
+)
+
+# --- Geolocation Configuration ---
+# States are resolved offline from bundled boundary polygons; Nominatim is only asked to settle
+# points that fall on (or just outside) a simplified border. The boundary index takes a few hundred
+# ms to build, so it is built during start-up warm-up and lookups wait for it.
+NOMINATIM_FALLBACK = os.getenv('NOMINATIM_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
 
 
 # --- Helper Functions ---
 
+# Credentials, discovery document and per-thread clients are created once and reused.
+drive_pool = DriveClientPool(GOOGLE_SERVICE_ACCOUNT_FILE, SCOPES, api_endpoint=DRIVE_API_URL)
+
 def get_drive_service():
-    """Authenticates with Google Drive API using a Service Account."""
+    """Returns a Drive API client authenticated with the Service Account."""
     try:
-        creds = Credentials.from_service_account_file('service_account.json', scopes=SCOPES)
-        return build('drive', 'v3', credentials=creds)
+        return drive_pool.service()
     except FileNotFoundError:
-        logger.error("service_account.json not found. Please follow the setup guide.")
+        logger.error(f"{GOOGLE_SERVICE_ACCOUNT_FILE} not found. Please follow the setup guide.")
         return None
     except Exception as e:
         logger.error(f"Failed to create Drive service: {e}")
         return None
 
-def init_db():
-    """Initializes the SQLite database and table."""
-    conn = sqlite3.connect('user_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        contact_info TEXT,
-        state TEXT,
-        screenshot_count INTEGER DEFAULT 0,
-        last_screenshot_time TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )''')
-    cursor.execute('''
-    CREATE TRIGGER IF NOT EXISTS update_users_timestamp
-    AFTER UPDATE ON users FOR EACH ROW
-    BEGIN
-        UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE user_id = OLD.user_id;
-    END;
-    ''')
-    conn.commit()
-    conn.close()
-
-def get_state_from_location(latitude, longitude):
+# Folder listings are served from memory; see DriveFolderIndex for how they are kept current.
+drive_index = DriveFolderIndex(DRIVE_FOLDER_IDS, get_drive_service, ttl=DRIVE_INDEX_TTL)
+
+def download_drive_file(file_id, fh):
+    """Blocking: streams a Drive file's content into the file object `fh` in 1 MiB chunks."""
+    drive_service = get_drive_service()
+    if not drive_service:
+        raise DriveUnavailableError("Drive service is unavailable")
+    from googleapiclient.http import MediaIoBaseDownload
+
+    request = drive_service.files().get_media(fileId=file_id)
+    downloader = MediaIoBaseDownload(fh, request, chunksize=1024 * 1024)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk()
+
+def get_drive_file_version(file_id):
+    """Blocking: returns a Drive file's md5Checksum (or modifiedTime) to key cached copies."""
+    drive_service = get_drive_service()
+    if not drive_service:
+        raise DriveUnavailableError("Drive service is unavailable")
+    file = drive_service.files().get(fileId=file_id, fields='md5Checksum, modifiedTime').execute()
+    return version_of(file)
+
+# Originals are downloaded once per version and kept on disk for re-renders.
+image_cache = ImageCache(
+    os.getenv('IMAGE_CACHE_DIR', 'image_cache'),
+    max_bytes=int(os.getenv('IMAGE_CACHE_MAX_MB', 512)) * 1024 * 1024,
+    download=download_drive_file,
+)
+
+# A state's images are shown as one numbered grid photo, rendered whenever its listing changes from
+# Drive's thumbnails, which are kept apart from the originals so they never evict each other.
+thumbnail_cache = ThumbnailCache(
+    http_client, drive_index.relist,
+    max_bytes=int(os.getenv('THUMBNAIL_CACHE_MAX_MB', 16)) * 1024 * 1024,
+    size=render_pipeline.sheet_cell,
+)
+contact_sheets = ContactSheets(thumbnail_cache, render_pipeline, media_cache)
+drive_index.add_listener(lambda state, files: contact_sheets.schedule(files[:IMAGES_PER_PAGE]))
+
+async def get_state_from_location(latitude, longitude):
+    """Gets Nigerian state from coordinates, asking Nominatim only for border ambiguities.
+
+    Asks Nominatim for every point while the boundary index can't be loaded (its warm-up is retried).
+    """
+    try:
+        state_locator = await warmup.result('state_locator')
+    except Exception as e:
+        logger.error(f"Offline state lookup unavailable, asking Nominatim: {e}")
+        metrics.inc('geocode_total', source='nominatim')
+        return await get_state_from_nominatim(latitude, longitude)
+    state, ambiguous = state_locator.locate(latitude, longitude)
+    if not ambiguous or not NOMINATIM_FALLBACK:
+        metrics.inc('geocode_total', source='offline')
+        return state
+    metrics.inc('geocode_total', source='nominatim')
+    return await get_state_from_nominatim(latitude, longitude) or state
+
+async def get_state_from_nominatim(latitude, longitude):
     """Gets Nigerian state from coordinates using Nominatim."""
-    url = f'https://nominatim.openstreetmap.org/reverse?format=json&lat={latitude}&lon={longitude}'
+    url = f'{NOMINATIM_URL}/reverse'
+    params = {'format': 'json', 'lat': latitude, 'lon': longitude}
     headers = {'User-Agent': 'NigeriaConnectBot/1.0'}
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
+        with metrics.span('nominatim'):
+            response = await http_client.get(url, params=params, headers=headers)
+            response.raise_for_status()
         data = response.json()
         state = data.get('address', {}).get('state', '').replace(' State', '')
         return state if state in NIGERIAN_STATES else None
-    except requests.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
         logger.error(f"Geolocation request failed: {e}")
         return None
 
+# Component stats exported as gauges on every scrape.
+metrics.add_stats('update_queue', update_processor.stats)
+metrics.add_stats('update_fetch', update_queue.stats)
+metrics.add_stats('send_queue', send_scheduler.stats)
+metrics.add_stats('drive_index', drive_index.stats)
+metrics.add_stats('image_cache', image_cache.stats)
+metrics.add_stats('thumbnail_cache', thumbnail_cache.stats)
+metrics.add_stats('telegram_file_cache', media_cache.stats)
+metrics.add_stats('render', render_pipeline.stats)
+metrics.add_stats('contact_sheets', contact_sheets.stats)
+metrics.add_stats('payment_reconciler', payment_reconciler.stats)
+metrics.add_stats('key_rotation', key_rotation.stats)
+metrics.add_collector(lambda: {'db_write_batches': database.batches, 'db_writes': database.writes})
+
+# --- Start-up Configuration ---
+# Importing this module only builds objects; the slow work runs after the Application is
+# initialized, as concurrent background steps, so updates are served (and /healthz answers) at
+# once. /readyz turns 200 when every step has finished and reports how long each took. Heavy
+# libraries (Google clients, PIL) are imported by the steps or render workers that use them.
+warmup = Warmup(started_at=_started_at)
+warmup.add('state_locator', lambda: asyncio.to_thread(StateLocator.from_file))
+warmup.add('render_workers', render_pipeline.warm)
+warmup.add('media_cache', media_cache.load)
+warmup.add('drive_client', lambda: asyncio.to_thread(drive_pool.service))
+# Listings schedule contact sheets, which are skipped if already uploaded, hence media_cache first.
+warmup.add('drive_index', drive_index.warm, after=('drive_client', 'media_cache'))
+warmup.add('contact_sheets', contact_sheets.wait_scheduled, after=('drive_index', 'render_workers'))
+metrics.add_stats('startup', warmup.stats)
+warmup.record('import', time.perf_counter() - _started_at)
+
 # --- Command Handlers ---
 
+@metrics.timed()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user if they want to connect."""
     keyboard = [
@@ -147,6 +356,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return SELECTING_ACTION
 
+@metrics.timed()
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
     await update.message.reply_text("Process cancelled. Type /start to begin again.")
@@ -160,21 +370,231 @@ async def user_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        conn = sqlite3.connect('user_data.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        count = cursor.fetchone()[0]
+        count = await repo.count_users()
         await update.message.reply_text(f"Total users in the database: {count}")
     except Exception as e:
         logger.error(f"Error fetching user count: {e}")
         await update.message.reply_text("Failed to retrieve user count.")
-    finally:
-        if conn:
-            conn.close()
+
+async def analytics_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show users, screenshots and payment conversion from the analytics counters."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    today = datetime.now(timezone.utc).date()
+    week_ago = (today - timedelta(days=6)).isoformat()
+    try:
+        users = await repo.get_counter('users')
+        users_by_day = await repo.get_counters('users_by_day', since=week_ago)
+        screenshots = await repo.get_counter('screenshots')
+        screenshots_today = await repo.get_counter('screenshots_by_day', today.isoformat())
+        initialized = await repo.get_counter('payments_initialized')
+        confirmed = await repo.get_counter('payments_confirmed')
+        by_state = await repo.get_counters('users_by_state')
+    except Exception as e:
+        logger.error(f"Error fetching analytics: {e}")
+        await update.message.reply_text("Failed to retrieve analytics.")
+        return
+
+    conversion = f"{confirmed / initialized:.1%}" if initialized else "n/a"
+    top_states = sorted(((count, state) for state, count in by_state.items() if count), reverse=True)[:5]
+    top_states = ', '.join(f"{state or 'Unknown'} {count}" for count, state in top_states) or 'n/a'
+    await update.message.reply_text(
+        "Analytics:\n"
+        f"Users: {users} (today: {users_by_day.get(today.isoformat(), 0)}, "
+        f"last 7 days: {sum(users_by_day.values())})\n"
+        f"Screenshots: {screenshots} (today: {screenshots_today})\n"
+        f"Payments: {initialized} initialized, {confirmed} confirmed ({conversion})\n"
+        f"Top states: {top_states}\n"
+        "Per-state counts: /stats_states"
+    )
+
+async def analytics_states(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to list users per state."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    by_state = await repo.get_counters('users_by_state')
+    lines = [f"{state or 'Unknown'}: {count}" for state, count in sorted(by_state.items()) if count]
+    await update.message.reply_text("Users per state:\n" + ("\n".join(lines) or "No users yet."))
+
+async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to download the users table (without contact info) as CSV."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    await send_csv(
+        update, 'users',
+        ['user_id', 'state', 'screenshot_count', 'last_screenshot_time', 'created_at', 'updated_at'],
+        repo.iter_user_rows(EXPORT_BATCH_SIZE),
+    )
+
+async def export_contacts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to download every user's decrypted contact info as CSV."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    logger.info(f"Admin {update.effective_user.id} exported decrypted contacts.")
+    await send_csv(
+        update, 'contacts', ['user_id', 'state', 'contact_info'],
+        iter_decrypted_contacts(repo, contact_cipher, EXPORT_BATCH_SIZE),
+    )
+
+async def send_csv(update: Update, name, header, batches):
+    """Streams row batches from an async iterator into a CSV and sends it as a document."""
+    rows = 0
+    # Written one page at a time; spills to disk past EXPORT_SPOOL_BYTES instead of growing in memory.
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as spool:
+        text = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(header)
+        async for batch in batches:
+            writer.writerows(batch)
+            rows += len(batch)
+        text.flush()
+        text.detach()
+        spool.seek(0)
+        await update.message.reply_document(
+            document=spool,
+            filename=f"{name}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.csv",
+            caption=f"{rows} {name}",
+        )
+
+async def rotate_keys(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to re-encrypt every stored contact under the newest key in ENCRYPTION_KEYS."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    if key_rotation.running:
+        await update.message.reply_text(f"Key rotation is already running ({key_rotation.rotated} rows so far).")
+        return
+    await update.message.reply_text(f"Re-encrypting contacts under key {contact_cipher.key_id}. I'll report back when it's done.")
+    context.application.create_task(run_key_rotation(context.bot, update.effective_chat.id))
+
+async def run_key_rotation(bot, admin_chat_id):
+    try:
+        rotated = await key_rotation.run()
+    except Exception as e:
+        logger.error(f"Key rotation failed: {e}")
+        await bot.send_message(chat_id=admin_chat_id, text=f"Key rotation failed: {e}")
+        return
+    stats = key_rotation.stats()
+    await bot.send_message(
+        chat_id=admin_chat_id,
+        text=f"Key rotation finished: {rotated} rows re-encrypted ({stats['rows_per_s'] or 0:,.0f} rows/s), "
+             f"{stats['unreadable']} unreadable with the configured keys.",
+    )
+
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show Drive folder index hit/miss/staleness counters."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    stats = drive_index.stats()
+    age = stats['oldest_listing_age']
+    await update.message.reply_text(
+        "Drive folder index:\n"
+        f"Hits: {stats['hits']} (stale: {stats['stale_hits']})\n"
+        f"Misses: {stats['misses']}\n"
+        f"Refreshes: {stats['refreshes']}, changes applied: {stats['changes_applied']}\n"
+        f"Folders indexed: {stats['folders_indexed']}/{len(DRIVE_FOLDER_IDS)}\n"
+        f"Oldest listing: {f'{age:.0f}s' if age is not None else 'n/a'}"
+    )
+    pool = drive_pool.stats()
+    await update.message.reply_text(
+        "Drive clients:\n"
+        f"Credentials load: {pool['credentials_load_ms'] or 0:.1f} ms\n"
+        f"Clients built: {pool['clients_built']} (avg {pool['avg_build_ms'] or 0:.1f} ms) "
+        f"for {pool['service_calls']} requests\n"
+        f"Token refreshes: {pool['token_refreshes']}, expires: {pool['token_expiry'] or 'n/a'}"
+    )
+    media = media_cache.stats()
+    sheets = contact_sheets.stats()
+    await update.message.reply_text(
+        "Telegram file ids:\n"
+        f"Hits: {media['hits']}, misses: {media['misses']}, cached: {media['entries']}\n"
+        f"Contact sheets: {sheets['renders']} rendered, {sheets['reuses']} reused, "
+        f"{sheets['rendered_waiting']} awaiting upload"
+    )
+    images = image_cache.stats()
+    await update.message.reply_text(
+        "Image cache:\n"
+        f"Hits: {images['hits']}, misses: {images['misses']}, evictions: {images['evictions']}\n"
+        f"Entries: {images['entries']} ({images['bytes'] / 1024 / 1024:.1f} MiB), in use: {images['pinned']}"
+    )
+    thumbnails = thumbnail_cache.stats()
+    await update.message.reply_text(
+        "Thumbnail cache:\n"
+        f"Hits: {thumbnails['hits']}, misses: {thumbnails['misses']}, re-lists: {thumbnails['relists']}, "
+        f"evictions: {thumbnails['evictions']}\n"
+        f"Entries: {thumbnails['entries']} ({thumbnails['bytes'] / 1024 / 1024:.1f} MiB)"
+    )
+
+async def queue_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to show update scheduler depth and wait times."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    stats = update_processor.stats()
+    p50, p95 = stats['wait_p50_ms'], stats['wait_p95_ms']
+    await update.message.reply_text(
+        "Update scheduler:\n"
+        f"Running: {stats['running']}/{stats['workers']} workers\n"
+        f"Pending: {stats['pending']}/{stats['max_pending']} ({stats['queued']} queued, "
+        f"{stats['keys_waiting']} users waiting, deepest queue {stats['deepest_queue']})\n"
+        f"Processed: {stats['processed']} (failed: {stats['failed']})\n"
+        f"Fetching held back: {update_queue.stats()['blocked']} times\n"
+        f"Wait p50/p95/max: {p50 or 0:.1f}/{p95 or 0:.1f}/{stats['max_wait_ms']:.1f} ms"
+    )
+    sends = send_scheduler.stats()
+    await update.message.reply_text(
+        "Outbound messages:\n"
+        f"Sent: {sends['sent']} (failed: {sends['failed']}, flood waits: {sends['retry_afters']}, "
+        f"global pauses: {sends['global_pauses']})\n"
+        f"Queued high/normal/bulk: {sends['queued_high']}/{sends['queued_normal']}/{sends['queued_bulk']}\n"
+        f"In flight: {sends['in_flight']}, paused for: {sends['paused_for']:.0f}s, "
+        f"max wait: {sends['max_wait_ms']:.0f} ms"
+    )
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to message every user: /broadcast <text>"""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text("Usage: /broadcast <message>")
+        return
+    await update.message.reply_text("Broadcast started. I'll report back when it's done.")
+    # Runs in the background so the admin's own updates aren't held up while it goes out.
+    context.application.create_task(run_broadcast(context.bot, update.effective_chat.id, text))
+
+async def run_broadcast(bot, admin_chat_id, text):
+    """Sends `text` to every user in the bulk lane, reading and sending one batch of ids at a time."""
+    delivered = failed = 0
+    async for user_ids in repo.iter_user_ids(BROADCAST_BATCH_SIZE):
+        results = await asyncio.gather(
+            *(bot.send_message(chat_id=user_id, text=text, rate_limit_args=PRIORITY_BULK) for user_id in user_ids),
+            return_exceptions=True,
+        )
+        errors = sum(isinstance(result, Exception) for result in results)
+        delivered += len(results) - errors
+        failed += errors
+    logger.info(f"Broadcast finished: {delivered} delivered, {failed} failed.")
+    await bot.send_message(chat_id=admin_chat_id, text=f"Broadcast finished: {delivered} delivered, {failed} failed.")
 
 
 # --- Conversation Steps ---
 
+@metrics.timed(state=SELECTING_ACTION)
 async def start_connection_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the 'Yes' button, asking for location."""
     query = update.callback_query
@@ -182,6 +602,7 @@ async def start_connection_flow(update: Update, context: ContextTypes.DEFAULT_TY
     await query.edit_message_text(text="Great! Please share your location so I can find connections in your state. You can use the paperclip icon to send your live or current location.")
     return GETTING_LOCATION
 
+@metrics.timed(state=SELECTING_ACTION)
 async def no_connection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the 'No' button, ending the conversation."""
     query = update.callback_query
@@ -189,6 +610,7 @@ async def no_connection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await query.edit_message_text(text="No problem. Feel free to come back anytime! Type /start to begin again.")
     return ConversationHandler.END
 
+@metrics.timed(state=GETTING_LOCATION)
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Processes location, fetches images, and presents them."""
     location = update.message.location
@@ -197,7 +619,7 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return GETTING_LOCATION
 
     await update.message.reply_text("Checking your location...")
-    state = get_state_from_location(location.latitude, location.longitude)
+    state = await get_state_from_location(location.latitude, location.longitude)
     if not state:
         await update.message.reply_text("Sorry, I couldn't determine a Nigerian state from your location. Please try again or /cancel.")
         return GETTING_LOCATION
@@ -205,67 +627,116 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     context.user_data['state'] = state
     await update.message.reply_text(f"Location confirmed: {state} State. Searching for available connections...")
 
-    drive_service = get_drive_service()
-    if not drive_service:
-        await update.message.reply_text("Error: The bot's connection to its data source is down. Please try again later. /cancel")
-        return ConversationHandler.END
-
     folder_id = DRIVE_FOLDER_IDS.get(state)
     if not folder_id:
         await update.message.reply_text(f"Sorry, no connections are available for {state} at the moment. Please check back later. /cancel")
         return ConversationHandler.END
 
     try:
-        results = drive_service.files().list(
-            q=f"'{folder_id}' in parents and mimeType contains 'image/'",
-            fields="files(id, name, thumbnailLink)",
-            pageSize=10  # Limit to 10 images
-        ).execute()
-        images = results.get('files', [])
-
-        if not images:
+        if not await show_page(update, context, 0):
             await update.message.reply_text(f"No connections found for {state}. /cancel")
             return ConversationHandler.END
-
-        context.user_data['images'] = {img['id']: img['name'] for img in images}
-        
-        # Send images as a media group
-        media_group = []
-        keyboard_buttons = []
-        for img in images:
-            # Using thumbnailLink for faster previews in the media group
-            media_group.append(InputMediaPhoto(media=img['thumbnailLink'], caption=img['name']))
-            keyboard_buttons.append([InlineKeyboardButton(f"Select {img['name']}", callback_data=f"image_{img['id']}")])
-        
-        await update.message.reply_media_group(media=media_group)
-        await update.message.reply_text(
-            "Here are the available connections. Please choose one to proceed to payment.",
-            reply_markup=InlineKeyboardMarkup(keyboard_buttons)
-        )
         return CHOOSING_IMAGE
 
+    except DriveUnavailableError:
+        await update.message.reply_text("Error: The bot's connection to its data source is down. Please try again later. /cancel")
+        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error fetching images from Drive: {e}")
         await update.message.reply_text("An error occurred while fetching connections. Please try again. /cancel")
         return ConversationHandler.END
 
+async def show_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int) -> bool:
+    """Shows one page of the user's state as a contact sheet with Select and Prev/Next buttons.
+
+    Sends a new photo for a message, or swaps the photo in place for a Prev/Next callback. Only the
+    state lives in user_data; the page number travels in the buttons' callback data and the page
+    itself is sliced from the folder index each time. The next page's sheet is rendered in the background while the user looks at this one.
+    Returns False if the state has no images.
+    """
+    state = context.user_data['state']
+    with metrics.span('drive_listing'):
+        images, page, total = await drive_index.page(state, page, IMAGES_PER_PAGE)
+    if not images:
+        return False
+    pages = -(-total // IMAGES_PER_PAGE)
+
+    keyboard_buttons = [
+        [InlineKeyboardButton(f"{number}. Select {img['name']}", callback_data=f"image_{img['id']}")]
+        for number, img in enumerate(images, 1)
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("« Prev", callback_data=f"page_{page - 1}"))
+    if page + 1 < pages:
+        navigation.append(InlineKeyboardButton("Next »", callback_data=f"page_{page + 1}"))
+    if navigation:
+        keyboard_buttons.append(navigation)
+    caption = "Here are the available connections. Please choose a number to proceed to payment."
+    if pages > 1:
+        caption += f" (Page {page + 1} of {pages})"
+
+    with metrics.span('contact_sheet'):
+        photo, digest = await contact_sheets.photo(images)
+    with metrics.span('send_contact_sheet'):
+        if update.callback_query:
+            message = await update.callback_query.edit_message_media(
+                InputMediaPhoto(media=photo, caption=caption),
+                reply_markup=InlineKeyboardMarkup(keyboard_buttons)
+            )
+        else:
+            message = await update.message.reply_photo(
+                photo=photo, caption=caption, reply_markup=InlineKeyboardMarkup(keyboard_buttons)
+            )
+    if not isinstance(photo, str) and isinstance(message, Message) and message.photo:
+        await contact_sheets.uploaded(digest, message.photo[-1].file_id)
+
+    if page + 1 < pages:
+        next_images, _, _ = await drive_index.page(state, page + 1, IMAGES_PER_PAGE)
+        contact_sheets.schedule(next_images)
+    return True
+
+@metrics.timed(state=CHOOSING_IMAGE)
+async def handle_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles the Prev/Next buttons under a contact sheet."""
+    query = update.callback_query
+    await query.answer()
+    try:
+        if not await show_page(update, context, int(query.data.replace('page_', ''))):
+            await query.message.reply_text(f"No connections found for {context.user_data['state']}. /cancel")
+            return ConversationHandler.END
+    except DriveUnavailableError:
+        await query.message.reply_text("Error: The bot's connection to its data source is down. Please try again later. /cancel")
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Error paging through Drive images: {e}")
+        await query.message.reply_text("An error occurred while fetching connections. Please try again. /cancel")
+        return ConversationHandler.END
+    return CHOOSING_IMAGE
+
+@metrics.timed(state=CHOOSING_IMAGE)
 async def handle_image_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles image selection and initiates payment."""
     query = update.callback_query
     await query.answer()
     image_id = query.data.replace('image_', '')
-    image_name = context.user_data['images'].get(image_id, "this connection")
+    image = drive_index.find(image_id)
+    if image is None:
+        await query.message.reply_text("Sorry, that connection is no longer available. Please choose another one.")
+        return CHOOSING_IMAGE
     context.user_data['selected_image_id'] = image_id
     
-    await query.edit_message_text(text=f"You have selected {image_name}. To get the contact details, a one-time fee of NGN 50 is required.")
+    # The choices are on a photo, so its caption is edited (which also removes the buttons)
+    await query.edit_message_caption(caption=f"You have selected {image['name']}. To get the contact details, a one-time fee of NGN 50 is required.")
 
     # Paystack Integration
     email = f"{update.effective_user.id}@telegram.user" # Dummy email
-    amount_kobo = 5000  # 50 NGN in kobo
+    amount_kobo = PAYMENT_AMOUNT_KOBO
     reference = f"tg_{update.effective_user.id}_{int(datetime.now().timestamp())}"
     context.user_data['payment_reference'] = reference
+    context.user_data.pop('payment_confirmed', None)
 
-    url = 'https://api.paystack.co/transaction/initialize'
+    url = f'{PAYSTACK_BASE_URL}/transaction/initialize'
     headers = {'Authorization': f'Bearer {PAYSTACK_SECRET_KEY}'}
     payload = {
         'email': email,
@@ -279,12 +750,14 @@ async def handle_image_selection(update: Update, context: ContextTypes.DEFAULT_T
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        with metrics.span('paystack_initialize'):
+            response = await http_client.post(url, headers=headers, json=payload)
+            response.raise_for_status()
         payment_data = response.json()
 
         if payment_data.get('status'):
             auth_url = payment_data['data']['authorization_url']
+            await repo.create_payment(reference, update.effective_user.id, image_id, amount_kobo)
             keyboard = [[InlineKeyboardButton("Pay NGN 50 Now", url=auth_url)]]
             await query.message.reply_text(
                 "Please complete the payment using the button below. I will notify you once it's confirmed.",
@@ -295,36 +768,25 @@ async def handle_image_selection(update: Update, context: ContextTypes.DEFAULT_T
             await query.message.reply_text("Could not initialize payment. Please try again. /cancel")
             return ConversationHandler.END
             
-    except requests.RequestException as e:
+    except (httpx.HTTPError, ValueError, KeyError, sqlite3.Error) as e:
         logger.error(f"Paystack initialization failed: {e}")
         await query.message.reply_text("Payment service is currently unavailable. Please try again later. /cancel")
         return ConversationHandler.END
 
+@metrics.timed(state=GETTING_CONTACT)
 async def handle_contact_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Saves user's contact info after successful payment."""
     user_id = update.effective_user.id
     contact_info = update.message.text
     state = context.user_data.get('state', 'Unknown')
 
-    encrypted_contact = cipher_suite.encrypt(contact_info.encode()).decode()
-
     try:
-        conn = sqlite3.connect('user_data.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO users (user_id, contact_info, state, screenshot_count)
-            VALUES (?, ?, ?, 0)
-            ON CONFLICT(user_id) DO UPDATE SET
-            contact_info = excluded.contact_info,
-            state = excluded.state;
-        """, (user_id, encrypted_contact, state))
-        conn.commit()
+        with metrics.span('db_save_contact'):
+            await repo.save_contact(user_id, contact_info, state)  # encrypted on the database writer thread
+        metrics.inc('contacts_saved_total')
     except Exception as e:
         logger.error(f"Database error while saving contact: {e}")
         await update.message.reply_text("A database error occurred. Your info was not saved. Please contact support.")
-    finally:
-        if conn:
-            conn.close()
 
     keyboard = [[InlineKeyboardButton(
         "Take one-time screenshot", 
@@ -343,133 +805,212 @@ async def handle_contact_info(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ConversationHandler.END
 
 
+@metrics.timed()
 async def handle_screenshot_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Generates and sends a protected, watermarked screenshot."""
     query = update.callback_query
     await query.answer()
 
-    user_id = query.effective_user.id
-    conn = sqlite3.connect('user_data.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT screenshot_count, last_screenshot_time FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    
-    count = result[0] if result else 0
-    last_time_str = result[1] if result and result[1] else None
+    user_id = update.effective_user.id
+    count, last_time_str = await repo.get_screenshot_status(user_id)
     
     if count >= 3:
         await query.edit_message_text("You have reached your screenshot limit (3).")
-        conn.close()
         return
 
     if last_time_str:
         last_time = datetime.fromisoformat(last_time_str)
         if (datetime.now() - last_time) < timedelta(minutes=5):
             await query.edit_message_text("Please wait 5 minutes between screenshot attempts.")
-            conn.close()
             return
     
     await query.edit_message_text("Generating your secure screenshot...")
 
     image_id = query.data.replace('screenshot_', '')
-    drive_service = get_drive_service()
-    if not drive_service:
-        await query.message.reply_text("Could not connect to the data source for the screenshot.")
-        conn.close()
-        return
-
     try:
-        request = drive_service.files().get_media(fileId=image_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        
-        fh.seek(0)
-        img = Image.open(fh)
-        
-        # Watermarking
-        draw = ImageDraw.Draw(img)
+        file = drive_index.find(image_id)
+        if file:
+            version = version_of(file)
+        else:
+            with metrics.span('drive_file_version'):
+                version = await asyncio.to_thread(get_drive_file_version, image_id)
+        with metrics.span('image_download'):
+            original = await image_cache.get(image_id, version)
+        watermark_text = f"For {update.effective_user.first_name} Only - Do Not Share"
         try:
-            font = ImageFont.truetype("arial.ttf", size=40)
-        except IOError:
-            font = ImageFont.load_default() # Fallback font
-        watermark_text = f"For {query.effective_user.first_name} Only - Do Not Share"
-        draw.text((10, 10), watermark_text, fill=(255, 0, 0, 128), font=font)
-        
-        # Resize/Blur for protection
-        img = img.resize((int(img.width * 0.6), int(img.height * 0.6)), Image.Resampling.LANCZOS)
-        
-        output = io.BytesIO()
-        img.save(output, format='PNG')
-        output.seek(0)
+            with metrics.span('render'):
+                output = await render_pipeline.render(original, watermark_text)
+        finally:
+            image_cache.release(original)
 
         # Update DB
-        cursor.execute(
-            "UPDATE users SET screenshot_count = screenshot_count + 1, last_screenshot_time = ? WHERE user_id = ?",
-            (datetime.now().isoformat(), user_id)
-        )
-        conn.commit()
+        await repo.record_screenshot(user_id, datetime.now().isoformat())
 
-        await query.message.reply_photo(
-            photo=output,
-            caption="**IMPORTANT**: This is your one-time screenshot. Saving or sharing this image is prohibited and tracked.",
-            protect_content=True,
-            parse_mode=ParseMode.MARKDOWN
-        )
+        with metrics.span('upload_screenshot'):
+            await query.message.reply_photo(
+                photo=output,
+                filename=f"screenshot.{render_pipeline.fmt.lower()}",
+                caption="**IMPORTANT**: This is your one-time screenshot. Saving or sharing this image is prohibited and tracked.",
+                protect_content=True,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        metrics.inc('screenshots_sent_total')
         await query.edit_message_text("Screenshot sent. This conversation is now complete. Type /start to begin again.")
 
+    except DriveUnavailableError:
+        await query.message.reply_text("Could not connect to the data source for the screenshot.")
     except Exception as e:
         logger.error(f"Screenshot generation failed for user {user_id}: {e}")
         await query.message.reply_text("Failed to generate screenshot. Please contact support.")
     finally:
-        conn.close()
         context.user_data.clear()
 
 
+async def confirm_payment(application: Application, payment_data: dict) -> bool:
+    """Marks a successful Paystack charge as paid and asks the user for their contact info.
+
+    Called for verified `charge.success` webhook events, payments found by the reconciler and
+    `/fakewebhook`. The payments ledger decides which of them handles a payment, so the user is
+    only asked once; returns False for the others.
+    """
+    reference = payment_data.get('reference')
+    metadata = payment_data.get('metadata') or {}
+    user_id = int(metadata['user_id'])
+    paid = await repo.mark_payment_paid(
+        reference, user_id, metadata.get('image_id'), payment_data.get('amount'), payment_data.get('paid_at')
+    )
+    if not paid:
+        logger.info(f"Ignoring duplicate payment confirmation: {reference}")
+        return False
+    await notify_payment(application, reference, user_id, metadata['image_id'])
+    return True
+
+async def notify_payment(application: Application, reference: str, user_id: int, image_id: str) -> None:
+    """Asks a user who has paid for their contact info, and records in the ledger that they were asked.
+
+    The flag lands in the user's persisted user_data, which `handle_awaiting_payment_message`
+    checks. If the message fails, the ledger row stays un-notified and the reconciler calls this again.
+    """
+    user_data = application.user_data[user_id]
+    user_data['payment_confirmed'] = reference
+    user_data['selected_image_id'] = image_id
+    metrics.inc('conversation_state_entered_total', state='GETTING_CONTACT')
+    application.mark_data_for_update_persistence(user_ids=user_id)
+
+    await application.bot.send_message(
+        chat_id=user_id,
+        text="✅ Payment confirmed!\n\nPlease provide your name and phone number so your connection can reach you. This will be kept private and encrypted.",
+        reply_markup=ForceReply(input_field_placeholder="e.g., Alex Johnson, +234..."),
+        rate_limit_args=PRIORITY_HIGH,
+    )
+    await repo.mark_payment_notified(reference)
+
+async def handle_awaiting_payment_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Treats text sent after a confirmed payment as the contact info; otherwise keeps waiting."""
+    if context.user_data.get('payment_confirmed'):
+        return await handle_contact_info(update, context)
+    await update.message.reply_text("Your payment hasn't been confirmed yet. I'll message you as soon as it is. /cancel")
+    return AWAITING_PAYMENT
+
 async def paystack_webhook_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles incoming webhooks from Paystack."""
-    data = update.effective_message.text  # In a real setup, this would be from a POST request body
-    # This is a simplified example. A real webhook needs a web server (Flask/FastAPI)
-    # For now, we'll simulate it with a command /fakewebhook {reference}
-    
-    reference = data.split()[-1] # e.g. /fakewebhook ref_123
+    """Verifies a payment by reference, for testing without the webhook server: /fakewebhook {reference}"""
+    reference = update.effective_message.text.split()[-1] # e.g. /fakewebhook ref_123
 
     # Verify payment using the reference from the webhook
-    url = f"https://api.paystack.co/transaction/verify/{reference}"
+    url = f"{PAYSTACK_BASE_URL}/transaction/verify/{reference}"
     headers = {'Authorization': f'Bearer {PAYSTACK_SECRET_KEY}'}
     try:
-        response = requests.get(url, headers=headers)
+        response = await http_client.get(url, headers=headers)
         response.raise_for_status()
         payment_data = response.json().get('data')
 
         if payment_data and payment_data['status'] == 'success':
-            user_id = int(payment_data['metadata']['user_id'])
-            image_id = payment_data['metadata']['image_id']
-            
-            # Save the image_id to the bot's user_data for the next step
-            context.bot_data.setdefault(user_id, {})['selected_image_id'] = image_id
-            
-            # Notify the user
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Payment confirmed!\n\nPlease provide your name and phone number so your connection can reach you. This will be kept private and encrypted.",
-                reply_markup=ForceReply(input_field_placeholder="e.g., Alex Johnson, +234...")
-            )
-            # You might need a way to advance the user's state here.
-            # This is a limitation of mixing webhooks with ConversationHandler without a persistent state backend.
+            await confirm_payment(context.application, payment_data)
         else:
             logger.warning(f"Webhook received for non-successful payment: {reference}")
 
-    except requests.RequestException as e:
+    except (httpx.HTTPError, ValueError, KeyError) as e:
         logger.error(f"Paystack webhook verification failed: {e}")
 
 
-def main() -> None:
-    """Run the bot."""
-    init_db()
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def poll_drive_changes(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job: applies Drive changes to the folder index."""
+    try:
+        await drive_index.poll_changes()
+    except Exception as e:
+        logger.error(f"Polling Drive changes failed: {e}")
+
+async def warm_contact_sheets(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job: uploads rendered contact sheets without a cached file_id to the warm-up chat."""
+    pending = contact_sheets.pending_uploads()[:MEDIA_WARMUP_BATCH]
+    for digest, data in pending:
+        try:
+            message = await context.bot.send_photo(
+                chat_id=MEDIA_WARMUP_CHAT_ID, photo=data,
+                disable_notification=True, rate_limit_args=PRIORITY_BULK,
+            )
+            await contact_sheets.uploaded(digest, message.photo[-1].file_id)
+        except Exception as e:
+            logger.warning(f"Could not pre-upload contact sheet {digest}: {e}")
+    if pending:
+        logger.info(f"Pre-uploaded {len(pending)} contact sheets to the warm-up chat.")
+
+async def refresh_drive_token(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job: renews the Drive access token before it expires."""
+    try:
+        await asyncio.to_thread(drive_pool.refresh_if_needed)
+    except Exception as e:
+        logger.error(f"Refreshing Drive token failed: {e}")
+
+async def reconcile_payments(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job: confirms pending payments whose webhook never arrived and retries failed notifications."""
+    try:
+        await payment_reconciler.run(functools.partial(confirm_payment, context.application),
+                                     functools.partial(notify_payment, context.application))
+    except httpx.HTTPError as e:
+        logger.warning(f"Payment reconciliation failed: {e}")
+
+async def post_init(application: Application) -> None:
+    """Opens shared resources once the Application is initialized and starts the warm-up."""
+    await http_client.start()
+    warmup.start()
+    application.job_queue.run_repeating(
+        poll_drive_changes, interval=DRIVE_CHANGES_POLL_INTERVAL, first=DRIVE_CHANGES_POLL_INTERVAL
+    )
+    application.job_queue.run_repeating(refresh_drive_token, interval=60, first=0)
+    application.job_queue.run_repeating(
+        reconcile_payments, interval=PAYMENT_RECONCILE_INTERVAL, first=PAYMENT_RECONCILE_INTERVAL
+    )
+    if MEDIA_WARMUP_CHAT_ID:
+        application.job_queue.run_repeating(warm_contact_sheets, interval=MEDIA_WARMUP_INTERVAL, first=30)
+    if BOT_MODE != 'webhook':
+        routes = health_routes(warmup)
+        if METRICS_ENABLED:
+            routes.append(('/metrics', MetricsHandler, {'metrics': metrics, 'token': METRICS_TOKEN}))
+        start_status_server(routes, METRICS_PORT)
+
+async def post_shutdown(application: Application) -> None:
+    """Releases shared resources when the Application shuts down."""
+    await http_client.close()
+    render_pipeline.shutdown()
+    await asyncio.to_thread(database.close)
+
+def build_application() -> Application:
+    """Builds the Application with every handler registered."""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .persistence(persistence)
+        .concurrent_updates(update_processor)
+        .update_queue(update_queue)
+        .rate_limiter(send_scheduler)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == 'webhook':
+        builder = builder.updater(None)  # updates arrive through WebhookServer instead
+    application = builder.build()
 
     # Conversation handler for the main user flow
     conv_handler = ConversationHandler(
@@ -480,17 +1021,20 @@ def main() -> None:
                 CallbackQueryHandler(no_connection, pattern='^connect_no$'),
             ],
             GETTING_LOCATION: [MessageHandler(filters.LOCATION, handle_location)],
-            CHOOSING_IMAGE: [CallbackQueryHandler(handle_image_selection, pattern='^image_')],
-            AWAITING_PAYMENT: [], # State is handled by webhook or timeout
+            CHOOSING_IMAGE: [
+                CallbackQueryHandler(handle_image_selection, pattern='^image_'),
+                CallbackQueryHandler(handle_page, pattern=r'^page_\d+$'),
+            ],
+            AWAITING_PAYMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_awaiting_payment_message)],
             GETTING_CONTACT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_contact_info)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         per_user=True,
         per_chat=True,
+        name='main_conversation',
+        persistent=True,
     )
     
-    # This is a hack to allow the webhook to inject data into the user's context
-    # A proper solution would use a persistent context (e.g., via DB)
     async def payment_success_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Simulates payment success to advance conversation. For testing."""
         if update.effective_user.id != ADMIN_USER_ID: return ConversationHandler.END
@@ -510,13 +1054,48 @@ def main() -> None:
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(handle_screenshot_request, pattern='^screenshot_'))
     application.add_handler(CommandHandler('user_count', user_count))
+    application.add_handler(CommandHandler('stats', analytics_stats))
+    application.add_handler(CommandHandler('stats_states', analytics_states))
+    application.add_handler(CommandHandler('export_users', export_users))
+    application.add_handler(CommandHandler('export_contacts', export_contacts))
+    application.add_handler(CommandHandler('rotate_keys', rotate_keys))
+    application.add_handler(CommandHandler('cache_stats', cache_stats))
+    application.add_handler(CommandHandler('queue_stats', queue_stats))
+    application.add_handler(CommandHandler('broadcast', broadcast))
     application.add_handler(CommandHandler('fakewebhook', paystack_webhook_handler)) # For testing webhook logic
+    return application
+
+def main() -> None:
+    """Run the bot."""
+    # Render workers are forked, so start them before anything else spins up threads.
+    with warmup.phase('render_fork'):
+        render_pipeline.start()
+    # The persistence reads from the database while the Application initializes.
+    with warmup.phase('database'):
+        database.start()
+    application = build_application()
 
     # Run the bot
     # For production, use webhooks. For development, polling is fine.
-    # application.run_webhook(listen="0.0.0.0", port=8443, url_path=TELEGRAM_TOKEN, webhook_url=f"{BOT_WEBHOOK_URL}/{TELEGRAM_TOKEN}")
-    logger.info("Starting bot with polling...")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        server = WebhookServer(
+            application,
+            on_payment=lambda data: confirm_payment(application, data),
+            webhook_url=BOT_WEBHOOK_URL,
+            telegram_path='/telegram',
+            secret_token=WEBHOOK_SECRET,
+            paystack_secret_key=PAYSTACK_SECRET_KEY,
+            port=PORT,
+        )
+        for route in health_routes(warmup):
+            server.add_route(*route)
+        if METRICS_ENABLED:
+            server.add_route('/metrics', MetricsHandler, {'metrics': metrics, 'token': METRICS_TOKEN})
+        logger.info("Starting bot with webhooks...")
+        asyncio.run(run_with_webhooks(application, server))
+    else:
+        logger.info("Starting bot with polling...")
+        application.run_polling()
 
 
 if __name__ == '__main__':
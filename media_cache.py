@@ -0,0 +1,54 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def version_of(file):
+    """Returns the version string of a Drive file metadata dict, to key cached copies of it."""
+    return file.get('md5Checksum') or file.get('modifiedTime') or ''
+
+
+class TelegramFileCache:
+    """Persistent map from an uploaded item (key + version) to the Telegram `file_id` of its upload.
+
+    Once Telegram has a copy of an image, later messages reference it by `file_id` instead of
+    uploading it again. `kind` separates different kinds of upload. Lookups are served from memory;
+    the table is read once during start-up warm-up.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._file_ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        """Loads every mapping into memory, keeping any recorded with `put` while it ran."""
+        rows = await self.repo.load_media_file_ids()
+        loaded = {(drive_id, version, kind): file_id for drive_id, version, kind, file_id in rows}
+        self._file_ids = {**loaded, **self._file_ids}
+        logger.info(f"Loaded {len(loaded)} cached Telegram file ids.")
+
+    def get(self, key, version, kind):
+        """Returns the cached Telegram file_id for an item, or None."""
+        file_id = self._file_ids.get((key, version, kind))
+        if file_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return file_id
+
+    def has(self, key, version, kind):
+        """Returns True if an item has a cached Telegram file_id, without counting a hit or miss."""
+        return (key, version, kind) in self._file_ids
+
+    async def put(self, key, version, kind, telegram_file_id):
+        """Records the Telegram file_id for an item."""
+        entry = (key, version, kind)
+        if self._file_ids.get(entry) == telegram_file_id:
+            return
+        self._file_ids[entry] = telegram_file_id
+        await self.repo.save_media_file_id(*entry, telegram_file_id)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._file_ids)}
@@ -0,0 +1,207 @@
+import bisect
+import functools
+import logging
+import time
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers everything from a cache hit to a slow Drive download.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class _Span:
+    __slots__ = ('metrics', 'labels', 'start')
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics._observe('span_seconds', time.perf_counter() - self.start, self.labels)
+        if exc_type is not None:
+            self.metrics._inc('span_errors_total', 1, self.labels)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metrics:
+    """In-process counters and latency histograms, rendered in the Prometheus text format.
+
+    `span(name)` times a block (an external call or a handler stage), `timed()` wraps a handler and
+    also counts the conversation states it moves users into, and collectors registered with
+    `add_collector` turn other components' `stats()` into gauges at scrape time. With
+    `enabled=False` spans are a shared no-op object, `timed()` returns the handler unchanged and
+    `inc`/`observe` return immediately. Meant to be used from the event loop thread.
+    """
+
+    def __init__(self, enabled=True, namespace='jaybot', buckets=DEFAULT_BUCKETS, state_names=None):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.state_names = state_names or {}
+        self._counters = {}  # name -> {label key: value}
+        self._histograms = {}  # name -> {label key: _Histogram}
+        self._collectors = []
+
+    def _inc(self, name, amount, labels):
+        series = self._counters.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def _observe(self, name, value, labels):
+        series = self._histograms.setdefault(name, {})
+        key = _key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = _Histogram(len(self.buckets))
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            histogram.counts[index] += 1
+        histogram.sum += value
+        histogram.count += 1
+
+    def inc(self, name, amount=1, **labels):
+        """Adds to a counter; `name` should end in `_total`."""
+        if self.enabled:
+            self._inc(name, amount, labels)
+
+    def observe(self, name, value, **labels):
+        """Records a value (in seconds, for latencies) in a histogram."""
+        if self.enabled:
+            self._observe(name, value, labels)
+
+    def span(self, name, **labels):
+        """Context manager timing a block into `span_seconds{span=name}`, counting failures."""
+        if not self.enabled:
+            return _NOOP_SPAN
+        labels['span'] = name
+        return _Span(self, labels)
+
+    def timed(self, name=None, state=None):
+        """Decorator for async handlers: records `handler_seconds` and `handler_errors_total`.
+
+        If the handler returns a conversation state listed in `state_names` other than `state` (the
+        state it runs in), `conversation_state_entered_total` is counted for it, which gives the
+        funnel from SELECTING_ACTION to GETTING_CONTACT.
+        """
+        def decorator(func):
+            if not self.enabled:
+                return func
+            labels = {'handler': name or func.__name__}
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception:
+                    self._inc('handler_errors_total', 1, labels)
+                    raise
+                finally:
+                    self._observe('handler_seconds', time.perf_counter() - start, labels)
+                if result != state and result in self.state_names:
+                    self._inc('conversation_state_entered_total', 1, {'state': self.state_names[result]})
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def add_collector(self, collect):
+        """Registers `collect() -> {name: value}`, exported as gauges on every scrape."""
+        self._collectors.append(collect)
+
+    def add_stats(self, prefix, stats):
+        """Exports the numeric values of a component's `stats()` dict as `<prefix>_<key>` gauges."""
+        def collect():
+            return {f'{prefix}_{key}': value for key, value in stats().items()
+                    if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        collect.__name__ = f'{prefix}_stats'
+        self.add_collector(collect)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        prefix = f'{self.namespace}_' if self.namespace else ''
+        for name, series in sorted(self._counters.items()):
+            lines.append(f'# TYPE {prefix}{name} counter')
+            for key, value in series.items():
+                lines.append(f'{prefix}{name}{_format_labels(key)} {value}')
+        for name, series in sorted(self._histograms.items()):
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}{name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+                lines.append(f'{prefix}{name}_bucket{_format_labels(key, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'{prefix}{name}_sum{_format_labels(key)} {histogram.sum}')
+                lines.append(f'{prefix}{name}_count{_format_labels(key)} {histogram.count}')
+        for collect in self._collectors:
+            try:
+                gauges = collect()
+            except Exception as e:
+                logger.warning(f"Metrics collector {collect.__name__} failed: {e}")
+                continue
+            for name, value in gauges.items():
+                if value is not None:
+                    lines.append(f'# TYPE {prefix}{name} gauge')
+                    lines.append(f'{prefix}{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves `Metrics.render()`; requires `Authorization: Bearer <token>` if a token is set."""
+
+    def initialize(self, metrics, token=None):
+        self.metrics = metrics
+        self.token = token
+
+    def get(self):
+        if self.token and self.request.headers.get('Authorization') != f'Bearer {self.token}':
+            raise tornado.web.HTTPError(401)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.metrics.render())
+
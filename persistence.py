@@ -0,0 +1,171 @@
+"""Persistence of conversations, user, chat and bot data to a Redis-style hash store.
+
+Run a single bot process per store. PTB's ConversationHandler keeps conversation states in memory
+and reads them only at startup, so a second process receiving updates would act on stale states.
+"""
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = 'user_data'
+CHAT_DATA = 'chat_data'
+BOT_DATA = 'bot_data'
+CONVERSATIONS = 'conversations:'
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class SQLiteKeyValueStore:
+    """Stand-in for a Redis client, backed by the bot's SQLite database.
+
+    Implements the subset of redis-py's asyncio hash commands that `StorePersistence` uses
+    (`hgetall`, `hset(name, mapping=...)`, `hdel`), so a `redis.asyncio.Redis` instance can
+    be swapped in unchanged.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def hgetall(self, name):
+        rows = await self.db.fetchall("SELECT key, value FROM kv_store WHERE namespace = ?", (name,))
+        return dict(rows)
+
+    async def hset(self, name, mapping):
+        def upsert(conn):
+            conn.executemany("""
+                INSERT INTO kv_store (namespace, key, value) VALUES (?, ?, ?)
+                ON CONFLICT(namespace, key) DO UPDATE SET
+                value = excluded.value,
+                updated_at = CURRENT_TIMESTAMP;
+            """, [(name, key, value) for key, value in mapping.items()])
+            return len(mapping)
+        return await self.db.write(upsert)
+
+    async def hdel(self, name, *keys):
+        def delete(conn):
+            return conn.executemany(
+                "DELETE FROM kv_store WHERE namespace = ? AND key = ?", [(name, key) for key in keys]
+            ).rowcount
+        return await self.db.write(delete)
+
+
+class StorePersistence(BasePersistence):
+    """`BasePersistence` over a Redis-style hash store, so conversations survive restarts.
+
+    Conversation states, user data, chat data and bot data are stored as JSON in one hash per
+    namespace. Writes are write-behind: the Application hands over changed entries every
+    `update_interval` seconds, entries whose JSON is unchanged since the last flush are skipped
+    (PTB reports every entry an update *touched*), and the rest go out as one `hset` per namespace.
+    Everything is read once, at startup.
+    """
+
+    def __init__(self, store, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self._flushed = {}  # (namespace, key) -> JSON last written to / read from the store
+        self._pending = {}  # namespace -> {key: JSON or None for delete}
+        self._flush_task = None
+        self.writes_skipped = 0
+        self.writes_flushed = 0
+
+    def _stage(self, namespace, key, value):
+        """Queues a change unless it matches what the store already holds; returns True if queued."""
+        encoded = None if value is None else json.dumps(value, sort_keys=True)
+        if self._flushed.get((namespace, key)) == encoded and key not in self._pending.get(namespace, {}):
+            self.writes_skipped += 1
+            return False
+        self._pending.setdefault(namespace, {})[key] = encoded
+        if self._flush_task is None:
+            # Every update_* call from one Application.update_persistence run lands before this.
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+        return True
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        try:
+            await self.flush()
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        """Writes every staged change to the store."""
+        pending, self._pending = self._pending, {}
+        for namespace, changes in pending.items():
+            upserts = {key: value for key, value in changes.items() if value is not None}
+            deletes = [key for key, value in changes.items() if value is None]
+            try:
+                if upserts:
+                    await self.store.hset(namespace, mapping=upserts)
+                if deletes:
+                    await self.store.hdel(namespace, *deletes)
+            except Exception as e:
+                logger.error(f"Persisting {namespace} failed, will retry: {e}")
+                for key, value in changes.items():
+                    self._pending.setdefault(namespace, {}).setdefault(key, value)
+                continue
+            for key, value in changes.items():
+                self._flushed[(namespace, key)] = value
+            self.writes_flushed += len(changes)
+
+    async def _load(self, namespace):
+        data = {}
+        for key, value in (await self.store.hgetall(namespace)).items():
+            key, value = _text(key), _text(value)
+            self._flushed[(namespace, key)] = value
+            data[key] = json.loads(value)
+        return data
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in (await self._load(USER_DATA)).items()}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in (await self._load(CHAT_DATA)).items()}
+
+    async def get_bot_data(self):
+        return (await self._load(BOT_DATA)).get('data', {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        stored = await self._load(CONVERSATIONS + name)
+        return {tuple(json.loads(key)): state for key, state in stored.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(CONVERSATIONS + name, json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._stage(USER_DATA, str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(CHAT_DATA, str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self._stage(BOT_DATA, 'data', data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._stage(USER_DATA, str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage(CHAT_DATA, str(chat_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass  # the in-memory copy is never older than the store
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,117 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# Ledger rows are written after Paystack created the transaction, so list from a little earlier.
+LIST_MARGIN = timedelta(minutes=5)
+
+
+def _sqlite_time(moment):
+    """Formats a UTC datetime the way SQLite's CURRENT_TIMESTAMP does."""
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PaymentReconciler:
+    """Confirms payments whose webhook never arrived, from Paystack's transaction list.
+
+    Each run marks ledger payments older than `window` as abandoned, then takes the pending ones
+    older than `grace` (younger ones are left to their webhook) and pages through successful
+    transactions since the oldest of them, `per_page` at a time, until every pending reference
+    has been seen or the list ends. Each match goes to `on_payment` with the ledger's user and
+    image. That is the same path webhooks take, and it marks the ledger paid at most once. A run
+    therefore costs a few list calls instead of one verify call per pending payment. Paid payments
+    whose user was never told (the message failed) are passed to `on_unnotified` once they have been
+    paid for longer than `grace`.
+    """
+
+    def __init__(self, repo, http_client, base_url, secret_key, window=24 * 3600, grace=120,
+                 per_page=100, max_pages=50):
+        self.repo = repo
+        self.http_client = http_client
+        self.base_url = base_url
+        self.secret_key = secret_key
+        self.window = timedelta(seconds=window)
+        self.grace = timedelta(seconds=grace)
+        self.per_page = per_page
+        self.max_pages = max_pages
+        self.runs = 0
+        self.list_calls = 0
+        self.reconciled = 0
+        self.renotified = 0
+        self.expired = 0
+        self.last_pending = 0
+        self.last_run_ms = None
+
+    async def run(self, on_payment, on_unnotified=None):
+        """Reconciles once; awaits `on_payment(transaction)` for each pending payment found paid.
+
+        `on_payment` returns True if it acted on the payment (False if a webhook got there first).
+        `on_unnotified(reference, user_id, image_id)` is awaited for each paid, never-notified one.
+        """
+        start = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        self.expired += await self.repo.expire_payments(_sqlite_time(now - self.window))
+        if on_unnotified is not None:
+            await self._renotify(on_unnotified, now)
+        pending = await self.repo.pending_payments(_sqlite_time(now - self.window), _sqlite_time(now - self.grace))
+        self.runs += 1
+        self.last_pending = len(pending)
+        if not pending:
+            return 0
+
+        oldest = min(created_at for _, _, created_at in pending.values())
+        since = datetime.strptime(oldest, '%Y-%m-%d %H:%M:%S') - LIST_MARGIN
+        headers = {'Authorization': f'Bearer {self.secret_key}'}
+        reconciled = calls = 0
+        for page in range(1, self.max_pages + 1):
+            response = await self.http_client.get(f'{self.base_url}/transaction', headers=headers, params={
+                'status': 'success', 'from': since.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'perPage': self.per_page, 'page': page,
+            })
+            response.raise_for_status()
+            self.list_calls += 1
+            calls = page
+            body = response.json()
+            for transaction in body.get('data') or ():
+                match = pending.pop(transaction.get('reference'), None)
+                if match is None:
+                    continue
+                user_id, image_id, _ = match
+                try:
+                    if await on_payment({**transaction, 'metadata': {'user_id': user_id, 'image_id': image_id}}):
+                        reconciled += 1
+                except Exception as e:
+                    logger.error(f"Resuming reconciled payment {transaction.get('reference')} failed: {e}")
+            if not pending or page >= int((body.get('meta') or {}).get('pageCount') or 1):
+                break
+
+        self.reconciled += reconciled
+        self.last_run_ms = (time.perf_counter() - start) * 1000
+        if reconciled:
+            logger.info(f"Reconciled {reconciled} payment(s) missed by webhooks with {calls} list call(s).")
+        return reconciled
+
+    async def _renotify(self, on_unnotified, now):
+        unnotified = await self.repo.unnotified_payments(_sqlite_time(now - self.window),
+                                                         _sqlite_time(now - self.grace))
+        for reference, (user_id, image_id) in unnotified.items():
+            try:
+                await on_unnotified(reference, user_id, image_id)
+                self.renotified += 1
+            except Exception as e:
+                logger.error(f"Notifying user {user_id} of payment {reference} failed again: {e}")
+        if unnotified:
+            logger.info(f"Retried {len(unnotified)} payment notification(s) that had failed.")
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'list_calls': self.list_calls,
+            'reconciled': self.reconciled,
+            'renotified': self.renotified,
+            'expired': self.expired,
+            'last_pending': self.last_pending,
+            'last_run_ms': self.last_run_ms,
+        }
@@ -0,0 +1,220 @@
+import asyncio
+import io
+import logging
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# PIL is imported inside the render functions: they run in the worker processes, so the bot
+# process itself never needs it (see `_init_worker`).
+
+logger = logging.getLogger(__name__)
+
+ORIENTATION_TAG = 0x0112
+
+# Set once per worker process by `_init_worker`, so the font file is parsed once, not per render.
+_font = None
+
+
+def _load_font(font_path, font_size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(font_path, size=font_size)
+    except IOError:
+        return ImageFont.load_default(size=font_size)  # Fallback font
+
+
+def _init_worker(font_path, font_size):
+    """Runs once in each worker process: imports PIL and parses the font before the first render."""
+    global _font
+    _font = _load_font(font_path, font_size)
+
+
+def render_watermarked(source, watermark_text, scale=0.6, fmt='JPEG', quality=80,
+                       font_path='arial.ttf', font_size=24, max_side=1280):
+    """Renders a reduced-size, watermarked copy of an image and returns the encoded bytes.
+
+    `source` is raw image bytes or a path, which is memory-mapped rather than read. The output is
+    `scale` times the original, capped at `max_side` pixels on the long side (Telegram downsizes
+    larger photos anyway). JPEGs are decoded at reduced resolution via `Image.draft`, so the
+    full-size original is never materialized, and the image is resized before the watermark is
+    drawn. Runs in a worker process; the font comes from `_init_worker`.
+    """
+    global _font
+    if _font is None:
+        _font = _load_font(font_path, font_size)
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _render(io.BytesIO(source), watermark_text, scale, fmt, quality, max_side)
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _render(mm, watermark_text, scale, fmt, quality, max_side)
+
+
+def _render(fp, watermark_text, scale, fmt, quality, max_side):
+    from PIL import Image, ImageDraw, ImageOps
+
+    with Image.open(fp) as img:
+        scale = min(scale, max_side / max(img.size))
+        target = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        # Lets the JPEG decoder scale by 1/2, 1/4 or 1/8 while staying at or above the target size.
+        img.draft('RGB', target)
+        if img.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+            target = target[::-1]  # Phone photos stored sideways; exif_transpose swaps the axes.
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != target:
+            img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        img.load()  # the source (possibly a memory map) is closed after this block
+
+    draw = ImageDraw.Draw(img)
+    draw.text((10, 10), watermark_text, fill=(255, 0, 0), font=_font)
+
+    output = io.BytesIO()
+    img.save(output, format=fmt, quality=quality)
+    return output.getvalue()
+
+
+def render_contact_sheet(sources, columns=5, cell=256, fmt='JPEG', quality=70,
+                         font_path='arial.ttf', font_size=24):
+    """Composites images into one numbered grid; returns the encoded bytes and the number of blank cells.
+
+    `sources` are raw image bytes (normally Drive thumbnails), paths (memory-mapped) or None for an
+    image that could not be fetched; those, and images that can't be read, leave a blank numbered
+    cell. Each image is draft-decoded and shrunk to fit a `cell`-pixel square. Runs in a worker
+    process.
+    """
+    global _font
+    if _font is None:
+        _font = _load_font(font_path, font_size)
+
+    from PIL import Image, ImageDraw
+
+    columns = max(1, min(columns, len(sources)))
+    rows = -(-len(sources) // columns)
+    sheet = Image.new('RGB', (columns * cell, rows * cell), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    blank = 0
+    for index, source in enumerate(sources):
+        x, y = (index % columns) * cell, (index // columns) * cell
+        try:
+            if source is None:
+                raise ValueError("image not available")
+            thumb = _load_thumbnail(source, cell - 8)
+            sheet.paste(thumb, (x + (cell - thumb.width) // 2, y + (cell - thumb.height) // 2))
+        except Exception as e:
+            blank += 1
+            logger.warning(f"Leaving cell {index + 1} of contact sheet blank: {e}")
+        label = str(index + 1)
+        left, top, right, bottom = draw.textbbox((0, 0), label, font=_font)
+        draw.rectangle((x + 4, y + 4, x + 16 + right - left, y + 12 + bottom - top), fill=(0, 0, 0))
+        draw.text((x + 10 - left, y + 8 - top), label, fill=(255, 255, 255), font=_font)
+
+    output = io.BytesIO()
+    sheet.save(output, format=fmt, quality=quality, optimize=True)
+    return output.getvalue(), blank
+
+
+def _load_thumbnail(source, size):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _thumbnail(io.BytesIO(source), size)
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _thumbnail(mm, size)
+
+
+def _thumbnail(fp, size):
+    from PIL import Image, ImageOps
+
+    with Image.open(fp) as img:
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        img.load()
+    return img
+
+
+class RenderPipeline:
+    """Runs screenshot and contact-sheet rendering in a bounded process pool off the event loop.
+
+    At most `max_workers` renders run at once and at most `max_queue` more wait for a worker;
+    callers beyond that wait on the event loop instead of piling work into the pool.
+    """
+
+    def __init__(self, max_workers=2, max_queue=8, fmt='JPEG', quality=80, scale=0.6, max_side=1280,
+                 font_path='arial.ttf', font_size=24, sheet_columns=5, sheet_cell=256, sheet_quality=70):
+        self.max_workers = max_workers
+        self.fmt = fmt
+        self.quality = quality
+        self.scale = scale
+        self.max_side = max_side
+        self.font_path = font_path
+        self.font_size = font_size
+        self.sheet_columns = sheet_columns
+        self.sheet_cell = sheet_cell
+        self.sheet_quality = sheet_quality
+        self._slots = asyncio.Semaphore(max_workers + max_queue)
+        self._executor = None
+        self._started = None  # future of a no-op task, done once a worker is up
+        self.in_flight = 0
+        self.rendered = 0
+
+    def start(self):
+        """Starts the worker processes; call this before the process starts any threads.
+
+        Uses the fork start method so workers don't re-import the bot's entry module; with fork the
+        pool launches every worker on the first submit, so that happens here rather than mid-run.
+        Returns once the workers are forked; they import PIL and load the font in the background
+        (await `warm()` to wait for that).
+        """
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+            initargs=(self.font_path, self.font_size),
+        )
+        self._started = self._executor.submit(int)
+        logger.info(f"Render pipeline started with {self.max_workers} workers.")
+
+    async def warm(self):
+        """Waits until the first worker process has initialized (the others start alongside it)."""
+        if self._executor is None:
+            self.start()
+        await asyncio.wrap_future(self._started)
+
+    async def _run(self, fn, *args):
+        if self._executor is None:
+            self.start()
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+            finally:
+                self.in_flight -= 1
+                self.rendered += 1
+
+    async def render(self, source, watermark_text):
+        """Renders a watermarked screenshot in a worker process and returns the encoded bytes."""
+        return await self._run(
+            render_watermarked, source, watermark_text,
+            self.scale, self.fmt, self.quality, self.font_path, self.font_size, self.max_side,
+        )
+
+    async def contact_sheet(self, sources):
+        """Renders a numbered grid of `sources` in a worker process; returns (JPEG bytes, blank cells)."""
+        return await self._run(
+            render_contact_sheet, sources, self.sheet_columns, self.sheet_cell, 'JPEG', self.sheet_quality,
+            self.font_path, self.font_size,
+        )
+
+    def stats(self):
+        return {'workers': self.max_workers, 'in_flight': self.in_flight, 'rendered': self.rendered}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
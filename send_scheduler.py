@@ -0,0 +1,280 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, passed to any bot method as `rate_limit_args`; lower runs first.
+PRIORITY_HIGH = 0  # payment confirmations
+PRIORITY_NORMAL = 1  # replies to the user's own actions (the default)
+PRIORITY_BULK = 2  # broadcasts and background uploads
+
+
+class TokenBucket:
+    """Token bucket that may go into debt, so a send costing more than `capacity` still goes out."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _fill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now, cost=1):
+        """Seconds until a send of `cost` messages may go out."""
+        self._fill(now)
+        needed = min(cost, self.capacity)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self, now, cost=1):
+        self._fill(now)
+        self.tokens -= cost
+
+    def full(self, now):
+        self._fill(now)
+        return self.tokens >= self.capacity
+
+
+class _Send:
+    __slots__ = ('priority', 'seq', 'cost', 'callback', 'args', 'kwargs', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, priority, seq, cost, callback, args, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.cost = cost
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Chat:
+    __slots__ = ('bucket', 'sends', 'scheduled', 'blocked_until')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.sends = []  # heap of _Send
+        self.scheduled = False  # waiting in a ready/delayed heap or being sent
+        self.blocked_until = 0.0
+
+
+def _seconds(retry_after):
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class SendScheduler(BaseRateLimiter):
+    """Central outbound queue for every Bot API call that targets a chat.
+
+    Sends pass a global token bucket (Telegram allows ~30 messages/s per bot) and a bucket per chat
+    (~1 message/s in private chats, 20/min in groups); a media group costs one token per item. The
+    dispatcher always picks the highest-priority send among chats that have tokens, and a chat
+    only has one send in flight at a time, so messages to a user arrive in the order they were
+    made. A `RetryAfter` from Telegram pauses that chat for the time it asks for and re-queues the
+    send at the front of its chat, up to `max_retries` times; other chats keep sending. Only when
+    `global_pause_after` chats are throttled at once (the bot itself is over its limit) is every
+    send paused until the last of them may resume. Calls without a chat_id (getMe,
+    answerCallbackQuery, ...) are not limited.
+
+    Pass the priority as `rate_limit_args`, e.g. `bot.send_message(..., rate_limit_args=PRIORITY_BULK)`.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=3,
+                 max_retries=3, global_pause_after=3, max_idle_chats=1024):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.global_pause_after = global_pause_after
+        self.max_idle_chats = max_idle_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []  # heap of (priority, seq, chat_id)
+        self._delayed = []  # heap of (ready_at, seq, chat_id)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._throttled = {}  # chat_id -> monotonic time its RetryAfter ends, for chats still blocked
+        self._wakeup = None
+        self._dispatcher = None
+        self._tasks = set()
+        self.sent = 0
+        self.failed = 0
+        self.retry_afters = 0
+        self.global_pauses = 0
+        self.max_wait = 0.0
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch(), name='send-scheduler')
+
+    async def shutdown(self):
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, *self._tasks, return_exceptions=True)
+        self._dispatcher = None
+        for chat in self._chats.values():
+            for send in chat.sends:
+                send.future.cancel()
+        self._chats.clear()
+        self._ready.clear()
+        self._delayed.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+        priority = PRIORITY_NORMAL if rate_limit_args is None else rate_limit_args
+        cost = len(data.get('media') or ()) if endpoint == 'sendMediaGroup' else 1
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(chat_id, _Send(priority, next(self._seq), max(cost, 1), callback, args, kwargs, future))
+        return await future
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = (TokenBucket(self.group_rate, self.group_burst) if is_group
+                      else TokenBucket(self.chat_rate, self.chat_burst))
+            chat = self._chats[chat_id] = _Chat(bucket)
+        return chat
+
+    def _enqueue(self, chat_id, send):
+        chat = self._chat(chat_id)
+        heapq.heappush(chat.sends, send)
+        if not chat.scheduled:
+            self._schedule(chat_id, chat)
+        self._wakeup.set()
+
+    def _schedule(self, chat_id, chat, now=None):
+        now = time.monotonic() if now is None else now
+        head = chat.sends[0]
+        delay = max(chat.bucket.delay(now, head.cost), chat.blocked_until - now)
+        if delay <= 0:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._delayed, (now + delay, head.seq, chat_id))
+        chat.scheduled = True
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                self._schedule(chat_id, self._chats[chat_id], now)
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            chat_id = self._ready[0][2]
+            chat = self._chats[chat_id]
+            wait = max(self._paused_until - now, self._global.delay(now, chat.sends[0].cost))
+            if wait > 0:
+                await asyncio.sleep(wait)  # then re-pick: something more urgent may have arrived
+                continue
+
+            heapq.heappop(self._ready)
+            send = heapq.heappop(chat.sends)
+            if send.future.done():  # the caller gave up while it was queued
+                chat.scheduled = False
+                if chat.sends:
+                    self._schedule(chat_id, chat, now)
+                continue
+            self._global.take(now, send.cost)
+            chat.bucket.take(now, send.cost)
+            self.max_wait = max(self.max_wait, now - send.enqueued_at)
+            task = asyncio.create_task(self._send(chat_id, chat, send))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            if len(self._chats) > self.max_idle_chats:
+                self._prune(now)
+
+    async def _send(self, chat_id, chat, send):
+        try:
+            result = await send.callback(*send.args, **send.kwargs)
+        except RetryAfter as e:
+            self.retry_afters += 1
+            if send.attempts >= self.max_retries or send.future.done():
+                self.failed += 1
+                if not send.future.done():
+                    send.future.set_exception(e)
+            else:
+                send.attempts += 1
+                delay = _seconds(e.retry_after)
+                resume_at = time.monotonic() + delay + 0.1
+                logger.info(f"Flood control hit sending to chat {chat_id}; pausing that chat for {delay:.0f}s.")
+                chat.blocked_until = resume_at
+                self._throttle(chat_id, resume_at)
+                heapq.heappush(chat.sends, send)  # keeps its place at the front of the chat
+        except Exception as e:
+            self.failed += 1
+            if not send.future.done():
+                send.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not send.future.done():
+                send.future.set_result(result)
+        finally:
+            chat.scheduled = False
+            if chat.sends:
+                self._schedule(chat_id, chat)
+                self._wakeup.set()
+
+    def _throttle(self, chat_id, resume_at):
+        """Records a throttled chat; pauses every send once `global_pause_after` chats are throttled."""
+        now = time.monotonic()
+        self._throttled = {other: until for other, until in self._throttled.items() if until > now}
+        self._throttled[chat_id] = resume_at
+        if len(self._throttled) >= self.global_pause_after:
+            paused_until = max(self._throttled.values())
+            if paused_until > self._paused_until:
+                self.global_pauses += 1
+                logger.warning(f"Flood control hit in {len(self._throttled)} chats at once; pausing all sends "
+                               f"for {paused_until - now:.0f}s.")
+                self._paused_until = paused_until
+
+    def _prune(self, now):
+        """Forgets idle chats whose bucket has refilled, so broadcasts don't grow the table forever."""
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.scheduled and not chat.sends and chat.bucket.full(now) and chat.blocked_until <= now:
+                del self._chats[chat_id]
+
+    def stats(self):
+        queued = [0, 0, 0]
+        for chat in self._chats.values():
+            for send in chat.sends:
+                queued[min(send.priority, PRIORITY_BULK)] += 1
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_afters': self.retry_afters,
+            'global_pauses': self.global_pauses,
+            'chats_throttled': sum(until > time.monotonic() for until in self._throttled.values()),
+            'in_flight': len(self._tasks),
+            'queued_high': queued[PRIORITY_HIGH],
+            'queued_normal': queued[PRIORITY_NORMAL],
+            'queued_bulk': queued[PRIORITY_BULK],
+            'chats_waiting': len(self._ready) + len(self._delayed),
+            'paused_for': max(0.0, self._paused_until - time.monotonic()),
+            'max_wait_ms': self.max_wait * 1000,
+        }
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Runs start-up work concurrently in the background and tracks when the bot is ready.
+
+    `add(name, step, after=())` registers a coroutine function; `start()` runs each step as its own
+    task once the steps named in `after` have succeeded. A failed step is retried with exponential
+    backoff (from `retry_base` up to `retry_max` seconds) until it succeeds, so a dependency that
+    was down at start-up doesn't keep the bot unready for the life of the process. `phase(name)`
+    times a blocking part of start-up, such as importing the bot, so the report covers the whole
+    start from `started_at`. The bot is ready once every step has succeeded.
+    `result(name)` awaits a step's return value, so a handler that needs something still warming up
+    waits for it instead of failing; it raises if the step's latest attempt failed.
+    """
+
+    def __init__(self, started_at=None, retry_base=1.0, retry_max=60.0):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._steps = {}  # name -> (coroutine function, names of steps it waits for)
+        self._tasks = {}  # name -> asyncio.Task, done once the step has succeeded
+        self._attempts = {}  # name -> asyncio.Future of the latest attempt
+        self._started = set()  # steps whose dependencies have finished
+        self._done = None
+        self.phases = {}  # name -> seconds
+        self.durations = {}  # name -> seconds
+        self.errors = {}  # name -> message of the latest attempt, while the step is failing
+        self.retries = {}  # name -> number of failed attempts
+        self.ready_after = None  # seconds from started_at until every step succeeded
+
+    @contextmanager
+    def phase(self, name):
+        """Times a blocking start-up phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def record(self, name, seconds):
+        """Records a phase measured elsewhere."""
+        self.phases[name] = seconds
+
+    def add(self, name, step, after=()):
+        self._steps[name] = (step, tuple(after))
+
+    def start(self):
+        """Starts every registered step; returns immediately."""
+        if self._done is not None:
+            return
+        for name in self._steps:
+            self._tasks[name] = asyncio.ensure_future(self._run(name))
+        self._done = asyncio.ensure_future(self._finish())
+
+    async def _run(self, name):
+        step, after = self._steps[name]
+        if after:
+            await asyncio.wait([self._tasks[dep] for dep in after])
+        self._started.add(name)
+        failures = 0
+        while True:
+            attempt = self._attempts[name] = asyncio.get_running_loop().create_future()
+            start = time.perf_counter()
+            try:
+                value = await step()
+            except Exception as e:
+                attempt.set_exception(e)
+                attempt.exception()  # mark retrieved; callers of result() see it, nobody else needs to
+                delay = min(self.retry_max, self.retry_base * 2 ** failures)
+                failures += 1
+                self.retries[name] = failures
+                self.errors[name] = str(e) or type(e).__name__
+                logger.error(f"Warm-up step {name} failed: {e}; retrying in {delay:.1f}s")
+            else:
+                attempt.set_result(value)
+                self.errors.pop(name, None)
+                return value
+            finally:
+                self.durations[name] = time.perf_counter() - start
+                logger.info(f"Warm-up step {name} took {self.durations[name] * 1000:.0f} ms")
+            await asyncio.sleep(delay)
+
+    async def _finish(self):
+        await asyncio.wait(self._tasks.values())
+        self.ready_after = time.perf_counter() - self.started_at
+        logger.info(f"Ready {self.ready_after * 1000:.0f} ms after start.")
+
+    async def wait(self):
+        """Waits until every step has finished."""
+        if self._done is not None:
+            await asyncio.shield(self._done)
+
+    async def result(self, name):
+        """Waits for a step and returns its result, or raises the exception of its latest attempt."""
+        task = self._tasks.get(name)
+        if task is None:
+            raise RuntimeError(f"Warm-up step {name} has not been started.")
+        if task.done():
+            return task.result()
+        attempt = self._attempts.get(name)
+        if attempt is None:
+            return await asyncio.shield(task)  # still waiting for the steps it depends on
+        return await asyncio.shield(attempt)
+
+    @property
+    def ready(self):
+        return self.ready_after is not None
+
+    def _status(self, name):
+        task = self._tasks.get(name)
+        if task is not None and task.done():
+            return 'done'
+        if name in self.errors:
+            return 'retrying'
+        return 'running' if name in self._started else 'waiting'
+
+    def report(self):
+        """Start-up breakdown served at /readyz."""
+        return {
+            'ready': self.ready,
+            'uptime_s': round(time.perf_counter() - self.started_at, 3),
+            'ready_after_ms': round(self.ready_after * 1000, 1) if self.ready else None,
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            'steps': {
+                name: {
+                    'status': self._status(name),
+                    'ms': round(self.durations[name] * 1000, 1) if name in self.durations else None,
+                    **({'retries': self.retries[name]} if name in self.retries else {}),
+                    **({'error': self.errors[name]} if name in self.errors else {}),
+                }
+                for name in self._steps
+            },
+        }
+
+    def stats(self):
+        return {
+            'ready': int(self.ready),
+            'ready_after_ms': self.ready_after * 1000 if self.ready else None,
+            'failed_steps': len(self.errors),
+            'step_retries': sum(self.retries.values()),
+            **{f'{name}_ms': seconds * 1000 for name, seconds in {**self.phases, **self.durations}.items()},
+        }
+
+
+class LivenessHandler(tornado.web.RequestHandler):
+    """/healthz: 200 as long as the event loop is serving requests, warmed up or not."""
+
+    def initialize(self, warmup):
+        self.warmup = warmup
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'status': 'ok', 'uptime_s': round(time.perf_counter() - self.warmup.started_at, 3)}))
+
+
+class ReadinessHandler(tornado.web.RequestHandler):
+    """/readyz: 200 once warm-up has finished, 503 until then; the body is `Warmup.report()`."""
+
+    def initialize(self, warmup):
+        self.warmup = warmup
+
+    def get(self):
+        self.set_status(200 if self.warmup.ready else 503)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.warmup.report()))
+
+
+def health_routes(warmup):
+    return [('/healthz', LivenessHandler, {'warmup': warmup}), ('/readyz', ReadinessHandler, {'warmup': warmup})]
+
+
+def start_status_server(routes, port, address='0.0.0.0'):
+    """Serves `routes` (health checks, /metrics) on their own port, for polling mode."""
+    app = tornado.web.Application(routes)
+    server = app.listen(port, address=address)
+    logger.info(f"Status endpoints ({', '.join(pattern for pattern, *_ in routes)}) on {address}:{port}")
+    return server
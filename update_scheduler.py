@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """Update queue that holds back the Updater while `limit` updates are unfinished.
+
+    The Application calls `task_done()` once an update has been processed, so the count covers
+    updates still queued, waiting for the update processor and running. The polling Updater awaits
+    `put()` for each update it fetched, so once the limit is reached it stops calling `getUpdates`
+    and the backlog stays with Telegram. Only `Update`s wait; the Application's own signals do not.
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.unfinished = 0
+        self.blocked = 0  # times the Updater had to wait for room
+        self._room = asyncio.Event()
+        self._room.set()
+
+    async def put(self, item):
+        if isinstance(item, Update):
+            while self.unfinished >= self.limit:
+                self.blocked += 1
+                self._room.clear()
+                await self._room.wait()
+        self.unfinished += 1
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self.unfinished -= 1
+        if self.unfinished < self.limit:
+            self._room.set()
+
+    def stats(self):
+        return {'unfinished': self.unfinished, 'limit': self.limit, 'blocked': self.blocked}
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes different users' updates concurrently while keeping each user's updates in order.
+
+    Every admitted update goes to a FIFO queue keyed by its user (falling back to the chat), and
+    `workers` tasks take turns over the keys that have work: a key is handed to one worker at a
+    time and goes to the back of the line after each update, so a user sending a burst can't
+    starve everyone else and the ConversationHandler never sees two updates of one user at once.
+
+    At most `max_pending` updates are admitted (queued or running); past that, new updates wait
+    for a slot and `saturated` is True so the webhook server can push back on Telegram. When
+    polling, pair it with a BoundedUpdateQueue so the Updater stops fetching instead.
+    """
+
+    def __init__(self, workers=16, max_pending=256, wait_samples=1000):
+        if max_pending < workers:
+            raise ValueError("max_pending must be at least the number of workers")
+        super().__init__(max_pending)
+        self.workers = workers
+        self._queues = {}  # key -> deque of (coroutine, future, enqueued_at)
+        self._ready = None
+        self._worker_tasks = []
+        self._waits = deque(maxlen=wait_samples)
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def key_for(update):
+        """Returns the ordering key of an update: its user, else its chat, else None."""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+        return None
+
+    @property
+    def pending(self):
+        """Updates admitted but not finished, queued or running."""
+        return self.current_concurrent_updates
+
+    @property
+    def saturated(self):
+        return self.pending >= self.max_concurrent_updates
+
+    async def initialize(self):
+        if self._worker_tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(), name=f'update-worker-{i}') for i in range(self.workers)
+        ]
+
+    async def shutdown(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for queue in self._queues.values():
+            for coroutine, future, _ in queue:
+                coroutine.close()
+                future.cancel()
+        self._queues.clear()
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key_for(update)
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((coroutine, future, time.monotonic()))
+        await future
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            coroutine, future, enqueued_at = queue.popleft()
+            wait = time.monotonic() - enqueued_at
+            self._waits.append(wait)
+            self.max_wait = max(self.max_wait, wait)
+            self.running += 1
+            try:
+                await coroutine
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(None)
+            finally:
+                self.running -= 1
+                self.processed += 1
+                if queue:
+                    self._ready.put_nowait(key)  # back of the line, behind other users
+                else:
+                    del self._queues[key]
+
+    def stats(self):
+        waits = sorted(self._waits)
+        return {
+            'workers': self.workers,
+            'running': self.running,
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'pending': self.pending,
+            'max_pending': self.max_concurrent_updates,
+            'keys_waiting': self._ready.qsize() if self._ready else 0,
+            'deepest_queue': max((len(queue) for queue in self._queues.values()), default=0),
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_p50_ms': waits[len(waits) // 2] * 1000 if waits else None,
+            'wait_p95_ms': waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000 if waits else None,
+            'max_wait_ms': self.max_wait * 1000,
+        }
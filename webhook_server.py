@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import signal
+
+import tornado.web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+def verify_paystack_signature(body, signature, secret_key):
+    """Returns True if `signature` is the HMAC-SHA512 of the raw body under the Paystack secret key."""
+    if not signature:
+        return False
+    expected = hmac.new(secret_key.encode(), body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class TelegramUpdateHandler(tornado.web.RequestHandler):
+    """Receives Telegram updates and hands them to the Application's update queue."""
+
+    def initialize(self, bot_application, secret_token):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        if getattr(self.bot_application.update_processor, 'saturated', False):
+            # Telegram redelivers after a non-2xx answer, so this sheds load instead of losing updates.
+            raise tornado.web.HTTPError(503)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        update = Update.de_json(data, self.bot_application.bot)
+        await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+
+class PaystackWebhookHandler(tornado.web.RequestHandler):
+    """Verifies Paystack events locally and queues `charge.success` for processing.
+
+    Paystack only needs a quick 200, so the event is acknowledged as soon as the signature checks
+    out and the actual work happens on `queue`.
+    """
+
+    def initialize(self, secret_key, queue):
+        self.secret_key = secret_key
+        self.queue = queue
+
+    async def post(self):
+        if not verify_paystack_signature(self.request.body, self.request.headers.get('x-paystack-signature'),
+                                         self.secret_key):
+            logger.warning("Rejected Paystack webhook with an invalid signature.")
+            raise tornado.web.HTTPError(401)
+        try:
+            event = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if event.get('event') == 'charge.success':
+            self.queue.put_nowait(event.get('data') or {})
+        self.set_status(200)
+
+
+class WebhookServer:
+    """Async HTTP server carrying both Telegram updates and Paystack events on one port.
+
+    `on_payment(data)` is awaited for every verified `charge.success` event by `workers` background
+    tasks. Extra `(pattern, handler, kwargs)` routes can be mounted with `add_route`.
+    """
+
+    def __init__(self, application, on_payment, webhook_url, telegram_path, secret_token,
+                 paystack_secret_key, paystack_path='/paystack/webhook', listen='0.0.0.0', port=8443,
+                 workers=4):
+        self.application = application
+        self.on_payment = on_payment
+        self.webhook_url = webhook_url.rstrip('/')
+        self.telegram_path = telegram_path
+        self.secret_token = secret_token
+        self.paystack_secret_key = paystack_secret_key
+        self.paystack_path = paystack_path
+        self.listen = listen
+        self.port = port
+        self.workers = workers
+        self.payment_queue = asyncio.Queue()
+        self.routes = [
+            (telegram_path, TelegramUpdateHandler, {'bot_application': application, 'secret_token': secret_token}),
+            (paystack_path, PaystackWebhookHandler, {'secret_key': paystack_secret_key, 'queue': self.payment_queue}),
+        ]
+        self._server = None
+        self._worker_tasks = []
+
+    def add_route(self, pattern, handler, kwargs=None):
+        self.routes.append((pattern, handler, kwargs or {}))
+
+    async def _payment_worker(self):
+        while True:
+            data = await self.payment_queue.get()
+            try:
+                await self.on_payment(data)
+            except Exception as e:
+                logger.error(f"Processing Paystack event {data.get('reference')} failed: {e}")
+            finally:
+                self.payment_queue.task_done()
+
+    async def start(self):
+        """Starts the HTTP server and payment workers, then registers the Telegram webhook."""
+        app = tornado.web.Application(self.routes)
+        self._server = app.listen(self.port, address=self.listen, xheaders=True)
+        self._worker_tasks = [asyncio.create_task(self._payment_worker()) for _ in range(self.workers)]
+        await self.application.bot.set_webhook(
+            url=f"{self.webhook_url}{self.telegram_path}",
+            secret_token=self.secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Webhook server listening on {self.listen}:{self.port}")
+
+    async def stop(self):
+        """Stops accepting requests and drains queued payment events."""
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        await self.payment_queue.join()
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks = []
+
+
+async def run_with_webhooks(application, server):
+    """Runs the Application behind `server` until SIGINT/SIGTERM, mirroring `run_polling`."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)